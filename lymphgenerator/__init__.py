@@ -1,4 +1,39 @@
 from .helpers  import *
 from .estimate_sbs_exposure import *
-from .viz import *
-from .__version__ import *
\ No newline at end of file
+from .exposure_cache import *
+from .maf_cache import *
+from .sbs_matrix import *
+from .nnls_fit import *
+from .metrics import *
+from .pipeline import *
+from .synthetic import *
+from .__version__ import *
+
+# Statistics and plotting pull in scipy, matplotlib and seaborn,
+# so their submodules are only imported when first used
+from importlib import import_module as _import_module
+
+_lazy_attributes = {
+    'group_pairs': 'pairwise_stats',
+    'adjust_pvalues': 'pairwise_stats',
+    'pairwise_mannwhitney': 'pairwise_stats',
+    'plot_and_whisker': 'viz',
+    'plot_stacked': 'viz',
+    'plot_and_whisker_batch': 'viz',
+    'plot_stacked_report': 'viz',
+    'run_benchmarks': 'benchmark',
+    'compare_benchmarks': 'benchmark'
+}
+
+# `from lymphgenerator import *` still exports everything
+__all__ = [name for name in globals() if not name.startswith('_')] + list(_lazy_attributes)
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(_import_module(f'.{_lazy_attributes[name]}', __name__), name)
+        globals()[name] = value
+        return(value)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return(sorted(set(globals()) | set(_lazy_attributes)))
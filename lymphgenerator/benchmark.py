@@ -0,0 +1,238 @@
+import argparse
+import shutil
+import tempfile
+import numpy as np
+import polars as pl
+from .helpers import _spawn_pool, cool_overlaps
+from .estimate_sbs_exposure import (
+    prepare_sbs_mafs,
+    scale_sbs_exposure,
+    select_represented_sbs
+)
+from .metrics import PipelineMetrics
+from .pairwise_stats import pairwise_mannwhitney
+from .synthetic import synthetic_activities, synthetic_maf, synthetic_panel
+
+benchmark_sizes = (10**3, 10**4, 10**5, 10**6, 10**7)
+
+# Multi-sample maf with about n variants, 1000 per sample
+def _maf_of_size(n, seed):
+    n_samples = max(1, n // 1000)
+    return(synthetic_maf(n_samples, max(1, n // n_samples), seed = seed))
+
+def _setup_cool_overlaps(n, seed):
+    return((_maf_of_size(n, seed), synthetic_panel(10000, seed = seed)))
+
+def _run_cool_overlaps(data):
+    maf_data, panel = data
+    return(cool_overlaps(maf_data, panel).height)
+
+def _setup_prepare_sbs_mafs(n, seed):
+    return((_maf_of_size(n, seed), tempfile.mkdtemp(prefix = 'lymphgenerator_')))
+
+def _run_prepare_sbs_mafs(data):
+    maf_data, out_path = data
+    try:
+        written = prepare_sbs_mafs(
+            out_path = out_path,
+            maf_data = maf_data,
+            metrics = PipelineMetrics(sinks = [])
+        )
+    finally:
+        shutil.rmtree(out_path, ignore_errors = True)
+    return(len(written))
+
+# Exposure tables hold one row per sample; n variants are taken
+# as n / 100 samples with 100 mutations each
+def _setup_scale_sbs_exposure(n, seed):
+    return(synthetic_activities(max(10, n // 100), n_signatures = 80, seed = seed))
+
+def _run_scale_sbs_exposure(data):
+    return(scale_sbs_exposure(data, metrics = PipelineMetrics(sinks = [])).height)
+
+def _setup_select_represented_sbs(n, seed):
+    return(
+        scale_sbs_exposure(
+            _setup_scale_sbs_exposure(n, seed),
+            metrics = PipelineMetrics(sinks = [])
+        )
+    )
+
+def _run_select_represented_sbs(data):
+    return(select_represented_sbs(data).width)
+
+# Statistics of a faceted plot_and_whisker: n values, 4 groups, 2 facets
+def _setup_pairwise_stats(n, seed):
+    rng = np.random.default_rng(seed)
+    return(
+        pl.DataFrame({
+            'exposure': rng.random(n),
+            'group': pl.Series(['FL', 'DLBCL', 'BL', 'MCL']).gather(rng.integers(0, 4, n)),
+            'facet': pl.Series(['FFPE', 'frozen']).gather(rng.integers(0, 2, n))
+        })
+    )
+
+def _run_pairwise_stats(data):
+    return(
+        pairwise_mannwhitney(
+            data,
+            'group',
+            'exposure',
+            groups = ['FL', 'DLBCL', 'BL', 'MCL'],
+            by = 'facet'
+        ).height
+    )
+
+benchmarks = {
+    'cool_overlaps': (_setup_cool_overlaps, _run_cool_overlaps),
+    'prepare_sbs_mafs': (_setup_prepare_sbs_mafs, _run_prepare_sbs_mafs),
+    'scale_sbs_exposure': (_setup_scale_sbs_exposure, _run_scale_sbs_exposure),
+    'select_represented_sbs': (_setup_select_represented_sbs, _run_select_represented_sbs),
+    'pairwise_stats': (_setup_pairwise_stats, _run_pairwise_stats)
+}
+
+# Set up and time one benchmark; setup is not part of the measurement
+# Times are the best of `repeat` runs, memory the highest
+def _measure(job):
+    name, size, seed, repeat = job
+    setup, run = benchmarks[name]
+    data = setup(size, seed)
+    metrics = PipelineMetrics(sinks = [])
+    for _ in range(repeat):
+        with metrics.stage(name) as record:
+            record['result'] = run(data)
+    records = metrics.records
+    # Memory is None where the platform does not report it
+    memory = records[0]['start_memory'] is not None
+    return(
+        {
+            'benchmark': name,
+            'size': size,
+            'result': records[0]['result'],
+            'wall_time': min(record['wall_time'] for record in records),
+            'cpu_time': min(record['cpu_time'] for record in records),
+            'peak_memory': max(record['peak_memory'] for record in records) if memory else None,
+            'memory_increase': max(
+                record['peak_memory'] - records[0]['start_memory'] for record in records
+            ) if memory else None
+        }
+    )
+
+def run_benchmarks(
+        sizes = benchmark_sizes,
+        names = None,
+        seed = 0,
+        repeat = 3,
+        isolate = True,
+        out_file = None
+):
+    """
+    Time the core functions on synthetic data of growing size.
+
+    Every benchmark in `names` (default: all of `benchmarks`) runs at
+    every size in `sizes`, counted in variants, keeping the best time of
+    `repeat` runs. With `isolate = True` each measurement runs in a fresh
+    process, so peak memory is not hidden by memory kept from earlier
+    runs. Returns one row per
+    measurement with wall and CPU time in seconds and peak and added
+    resident memory in bytes, and optionally writes it to csv.
+    """
+
+    jobs = [
+        (name, size, seed, repeat)
+        for name in (names if names is not None else benchmarks)
+        for size in sizes
+    ]
+    results = []
+    for job in jobs:
+        if isolate:
+            with _spawn_pool(1) as pool:
+                result = pool.submit(_measure, job).result()
+        else:
+            result = _measure(job)
+        memory = '' if result['memory_increase'] is None \
+            else f", +{result['memory_increase'] / 1e6:.0f} MB"
+        print(
+            f"{result['benchmark']} at {result['size']:,}: "
+            f"{result['wall_time']:.3f} s{memory}"
+        )
+        results.append(result)
+
+    results = pl.DataFrame(results)
+    if out_file is not None:
+        results.write_csv(out_file)
+    return(results)
+
+# Compare benchmark results to an earlier run
+# Time or memory growing by more than `tolerance` fold counts as a
+# regression; time differences below `min_time` seconds and memory
+# differences below `min_memory` bytes are noise. Memory is compared on
+# `memory_increase`, what the function added over the memory of the
+# process before the call, since the interpreter and libraries alone
+# take far more than most functions allocate
+def compare_benchmarks(
+        results,
+        baseline,
+        tolerance = 1.25,
+        min_time = 0.1,
+        min_memory = 2**23
+):
+    if not isinstance(baseline, pl.DataFrame):
+        baseline = pl.read_csv(baseline)
+    if not isinstance(results, pl.DataFrame):
+        results = pl.read_csv(results)
+
+    return(
+        results.join(
+            baseline.select(['benchmark', 'size', 'wall_time', 'memory_increase']),
+            on = ['benchmark', 'size'],
+            how = 'inner',
+            suffix = '_baseline'
+        ).with_columns(
+            time_ratio = pl.col('wall_time') / pl.col('wall_time_baseline'),
+            memory_ratio = (
+                pl.col('memory_increase') /
+                pl.col('memory_increase_baseline').clip(lower_bound = 1)
+            )
+        ).with_columns(
+            regression = (
+                (pl.col('time_ratio') > tolerance) &
+                (pl.col('wall_time') - pl.col('wall_time_baseline') > min_time)
+            ) | (
+                (pl.col('memory_ratio') > tolerance) &
+                (pl.col('memory_increase') - pl.col('memory_increase_baseline') > min_memory)
+            )
+        )
+    )
+
+# Run as `python -m lymphgenerator.benchmark`
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = 'python -m lymphgenerator.benchmark',
+        description = 'Benchmark lymphgenerator on synthetic maf data'
+    )
+    parser.add_argument('--sizes', type = int, nargs = '+', default = list(benchmark_sizes))
+    parser.add_argument('--benchmarks', nargs = '+', default = None, choices = list(benchmarks))
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Runs per measurement, the best time is kept')
+    parser.add_argument('--out', default = None, help = 'Write results to this csv file')
+    parser.add_argument('--baseline', default = None, help = 'Compare with results of an earlier run')
+    parser.add_argument('--tolerance', type = float, default = 1.25)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        sizes = args.sizes,
+        names = args.benchmarks,
+        seed = args.seed,
+        repeat = args.repeat,
+        out_file = args.out
+    )
+    if args.baseline is not None:
+        comparison = compare_benchmarks(results, args.baseline, tolerance = args.tolerance)
+        regressions = comparison.filter(pl.col('regression'))
+        print(comparison.select(['benchmark', 'size', 'time_ratio', 'memory_ratio', 'regression']))
+        if regressions.height:
+            raise SystemExit(f'{regressions.height} benchmarks regressed')
+
+if __name__ == '__main__':
+    main()
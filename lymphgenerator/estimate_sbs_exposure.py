@@ -1,122 +1,1027 @@
 import polars as pl
+import numpy as np
 from pathlib import Path
 import pathlib
-import sys
+import os
+import glob
+import shutil
+import tempfile
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from .helpers import (
+    PanelIndex,
+    _atomic_write,
+    _link_or_copy,
+    _spawn_pool,
+    cool_overlaps,
+    sanitize_sample_name,
+    sbs_maf_columns,
+    sigprofiler_maf_layout
+)
+from .metrics import PipelineMetrics
+from .maf_cache import MafCache, maf_schema
 
 # Helper function to save individual maf files
+# Data staged as vcf (see `stage_sbs`) is written as a minimal vcf file
 def save_maf(
         incoming_maf,
-        out_path = str
+        out_path = str,
+        file_name = None
 ):
     # Account for the case when empty maf is passed
     try:
         name = incoming_maf['Tumor_Sample_Barcode'].unique().to_list()[0]
     except IndexError:
         return None
-    path = f"{out_path}/{name}.maf"
+    if file_name is None:
+        file_name = sanitize_sample_name(name)
+
+    if '#CHROM' in incoming_maf.columns:
+        path = f"{out_path}/{file_name}.vcf"
+        with open(path, 'w') as out:
+            out.write('##fileformat=VCFv4.1\n')
+            incoming_maf.drop('Tumor_Sample_Barcode').write_csv(out, separator = '\t')
+        return(path)
+
+    path = f"{out_path}/{file_name}.maf"
 
     # Convert to a regular DataFrame and write to a TSV file
     incoming_maf.write_csv(path, separator='\t')
 
-# Split multi-sample maf file to individual files
-# at user-specified location
-def prepare_sbs_mafs(
+    return(path)
+
+# Reduce maf data to what SBS96 fitting reads, before writing it out
+# Only single-base substitutions are kept. With `staging = 'maf'` the
+# positional maf layout keeps only `sbs_maf_columns` filled; 'vcf' gives
+# the columns of a minimal vcf, which SigProfiler also reads as input.
+# The sample id stays in `Tumor_Sample_Barcode` for splitting
+def stage_sbs(
+        maf_data,
+        staging = 'maf'
+):
+    if staging not in ('maf', 'vcf'):
+        raise ValueError(f"staging must be 'maf' or 'vcf', not {staging!r}")
+
+    snvs = maf_data.filter(
+        (pl.col('Variant_Type') == 'SNP') &
+        pl.col('Reference_Allele').str.contains('^[ACGTacgt]$') &
+        pl.col('Tumor_Seq_Allele2').str.contains('^[ACGTacgt]$')
+    )
+
+    if staging == 'vcf':
+        return(
+            snvs.select(
+                pl.col('Chromosome').cast(pl.String).alias('#CHROM'),
+                pl.col('Start_Position').alias('POS'),
+                pl.lit('.').alias('ID'),
+                pl.col('Reference_Allele').str.to_uppercase().alias('REF'),
+                pl.col('Tumor_Seq_Allele2').str.to_uppercase().alias('ALT'),
+                pl.lit('.').alias('QUAL'),
+                pl.lit('PASS').alias('FILTER'),
+                pl.lit('.').alias('INFO'),
+                pl.col('Tumor_Sample_Barcode')
+            )
+        )
+
+    return(
+        _subset_maf(
+            snvs.lazy(),
+            columns = sbs_maf_columns,
+            snps_only = False
+        ).collect()
+    )
+
+# Write every sample of multi-sample maf to its own file in one pass
+# Only row indices are kept per sample; each partition is gathered
+# right before it is written, so at most n_jobs partitions live in memory
+# With `staging`, only what SBS96 fitting reads is written, see `stage_sbs`
+# `return_names = True` returns the sample id of every written file, by path
+def write_sample_mafs(
+        maf_data,
         out_path = str,
+        n_jobs = 4,
+        return_partitions = False,
+        return_names = False,
+        staging = None,
+        metrics = None
+):
+    Path(out_path).mkdir(parents = True, exist_ok = True)
+    if staging is not None:
+        maf_data = stage_sbs(maf_data, staging = staging)
+
+    groups = maf_data.with_row_index(
+        '_row'
+    ).group_by(
+        'Tumor_Sample_Barcode',
+        maintain_order = True
+    ).agg(
+        pl.col('_row')
+    )
+
+    # Different ids can sanitize to the same file name
+    file_names = []
+    seen = {}
+    for name in groups['Tumor_Sample_Barcode']:
+        file_name = sanitize_sample_name(name)
+        seen[file_name] = seen.get(file_name, 0) + 1
+        if seen[file_name] > 1:
+            file_name = f"{file_name}_{seen[file_name]}"
+        file_names.append(file_name)
+
+    def _write(job):
+        file_name, sample, rows = job
+        measure = metrics.sample('split', sample) if metrics is not None else nullcontext({})
+        with measure as record:
+            partition = maf_data[rows]
+            path = save_maf(partition, out_path = out_path, file_name = file_name)
+            record.update(rows = partition.height, bytes = os.path.getsize(path))
+        return(partition if return_partitions else path)
+
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        written = list(
+            pool.map(
+                _write,
+                zip(file_names, groups['Tumor_Sample_Barcode'].to_list(), groups['_row'].to_list())
+            )
+        )
+
+    if return_names:
+        return(dict(zip(written, groups['Tumor_Sample_Barcode'].to_list())))
+    return(written)
+
+# Apply column selection and row filters to a lazy maf
+# Everything stays in the query plan, so polars pushes it into the reader
+def _subset_maf(
+        maf_data,
+        columns = sbs_maf_columns,
+        snps_only = True,
+        samples = None,
+        subset_to_panel = False,
+        panel = None
+):
+    if columns is not None:
+        maf_data = maf_data.select(columns)
+
+    if snps_only:
+        maf_data = maf_data.filter(pl.col('Variant_Type') == 'SNP')
+
+    if samples is not None:
+        maf_data = maf_data.filter(
+            pl.col('Tumor_Sample_Barcode').is_in(list(samples))
+        )
+
+    if subset_to_panel:
+        maf_data = cool_overlaps(maf_data, panel)
+
+    # Keep the positional maf layout SigProfiler expects
+    # Columns that were not read are written out empty
+    if columns is not None:
+        layout = [
+            pl.col(col) if col in columns
+            else pl.lit(None, dtype = pl.String).alias(col)
+            for col in sigprofiler_maf_layout
+        ]
+        extra = [col for col in columns if col not in sigprofiler_maf_layout]
+        maf_data = maf_data.select(layout + extra)
+
+    return(maf_data)
+
+# Maf files named by a path, a glob pattern or a list of either
+# Patterns expand in sorted order, so the row order is reproducible
+def maf_paths(file_path):
+    if isinstance(file_path, (str, os.PathLike)):
+        file_path = [file_path]
+    paths = []
+    for item in map(str, file_path):
+        if any(char in item for char in '*?['):
+            matches = sorted(glob.glob(item))
+            if not matches:
+                raise FileNotFoundError(f'No maf files match {item}')
+            paths.extend(matches)
+        elif os.path.exists(item):
+            paths.append(item)
+        else:
+            raise FileNotFoundError(f'Maf file not found: {item}')
+    return(paths)
+
+# Maf text is read without inference and cast to `maf_schema`, so one
+# file or many give the same dtypes. Labels stay strings and
+# non-standard columns are kept as strings
+_maf_read_schema = {
+    col: pl.String if dtype == pl.Categorical else dtype
+    for col, dtype in maf_schema.items()
+}
+
+def _reconcile_maf(maf_data):
+    return(
+        maf_data.with_columns(
+            [
+                pl.col(col).cast(_maf_read_schema[col], strict = False)
+                for col in maf_data.collect_schema().names()
+                if _maf_read_schema.get(col, pl.String) != pl.String
+            ]
+        )
+    )
+
+# Typed copies of all maf files from the cache, see `MafCache`
+def _load_cached_mafs(
+        maf_cache,
+        file_path,
+        lazy = False
+):
+    if not isinstance(maf_cache, MafCache):
+        maf_cache = MafCache(maf_cache)
+    return(
+        pl.concat(
+            [
+                maf_cache.load(path, lazy = lazy)
+                for path in maf_paths(file_path)
+            ],
+            how = 'diagonal',
+            rechunk = False
+        )
+    )
+
+# Lazily scan maf file, only reading the columns and rows needed
+# A glob pattern or a list of files is scanned as one table, the
+# files missing a column get nulls for it
+def scan_maf(
+        file_path,
+        columns = sbs_maf_columns,
+        snps_only = True,
+        samples = None,
+        subset_to_panel = False,
+        panel = None
+):
+    maf_data = pl.concat(
+        [
+            _reconcile_maf(
+                pl.scan_csv(
+                    source = path,
+                    has_header = True,
+                    separator = '\t',
+                    comment_prefix = '#',
+                    infer_schema = False
+                )
+            )
+            for path in maf_paths(file_path)
+        ],
+        how = 'diagonal'
+    )
+
+    return(
+        _subset_maf(
+            maf_data,
+            columns = columns,
+            snps_only = snps_only,
+            samples = samples,
+            subset_to_panel = subset_to_panel,
+            panel = panel
+        )
+    )
+
+# Read one maf file with the sample and panel filters applied
+def _read_maf_file(
+        file_path,
+        samples = None,
+        subset_to_panel = False,
+        panel = None
+):
+    maf_data = _reconcile_maf(
+        pl.read_csv(
+            source = file_path,
+            has_header = True,
+            separator = '\t',
+            comment_prefix = '#',
+            infer_schema = False
+        )
+    )
+    if samples is not None:
+        maf_data = maf_data.filter(
+            pl.col('Tumor_Sample_Barcode').is_in(list(samples))
+        )
+    if subset_to_panel:
+        maf_data = cool_overlaps(maf_data, panel)
+    return(maf_data)
+
+# Read maf data from file or data frame, keeping the
+# requested samples and, optionally, variants within the panel
+# `file_path` may also be a glob pattern or a list of files; these are
+# read by `n_jobs` threads and combined without copying their data
+def load_maf(
         subset_to_panel = False,
         panel = None,
+        lazy = False,
+        samples = None,
+        columns = sbs_maf_columns,
+        maf_cache = None,
+        n_jobs = 4,
         **mafs
 ):
-    print('Preprocessing incoming maf file ...')
+    if 'file_path' not in mafs and 'maf_data' not in mafs:
+        raise ValueError('Please provide maf data as file_path or maf_data')
+
+    # Typed copy of every maf file, converted on first use
+    if maf_cache is not None and 'file_path' in mafs:
+        mafs = {'maf_data': _load_cached_mafs(maf_cache, mafs['file_path'], lazy = lazy)}
+
+    if lazy:
+        # Columns, SNP, sample and panel filters are pushed into the scan
+        # and the query runs on the streaming engine
+        if 'file_path' in mafs:
+            maf_data = scan_maf(
+                mafs['file_path'],
+                columns = columns,
+                samples = samples,
+                subset_to_panel = subset_to_panel,
+                panel = panel
+            )
+        else:
+            maf_data = _subset_maf(
+                mafs['maf_data'].lazy(),
+                columns = columns,
+                samples = samples,
+                subset_to_panel = subset_to_panel,
+                panel = panel
+            )
+
+        return(maf_data.collect(engine = 'streaming'))
 
     if 'file_path' in mafs:
-        maf_data = pl.read_csv(
-            source = mafs['file_path'],
+        # Filters run per file; the chunks of all files are kept as they
+        # are and only gathered per sample when writing
+        paths = maf_paths(mafs['file_path'])
+        with ThreadPoolExecutor(max_workers = max(1, min(n_jobs, len(paths)))) as executor:
+            parts = list(
+                executor.map(
+                    lambda path: _read_maf_file(
+                        path,
+                        samples = samples,
+                        subset_to_panel = subset_to_panel,
+                        panel = panel
+                    ),
+                    paths
+                )
+            )
+        return(pl.concat(parts, how = 'diagonal', rechunk = False))
+
+    maf_data = mafs['maf_data']
+
+    if samples is not None:
+        maf_data = maf_data.filter(
+            pl.col('Tumor_Sample_Barcode').is_in(list(samples))
+        )
+
+    # Overlaps are row-wise, so the panel is applied once to the cohort
+    if subset_to_panel:
+        maf_data = cool_overlaps(maf_data, panel)
+
+    return(maf_data)
+
+# Read tab-separated maf file in blocks of about `chunk_size` bytes
+# Blocks end at a line break and every one is parsed on its own, so
+# memory depends on the block size, not the size of the file. Values
+# are kept as text exactly as written in the file
+def read_maf_chunks(
+        file_path,
+        chunk_size = 2**24
+):
+    with open(file_path, 'rb') as maf_file:
+        header = maf_file.readline()
+        while header.startswith(b'#'):
+            header = maf_file.readline()
+        rest = b''
+        while True:
+            block = maf_file.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            block, rest = block[:cut], block[cut:]
+            if block:
+                yield(_parse_maf_block(header, block))
+        if rest.strip():
+            yield(_parse_maf_block(header, rest))
+
+def _parse_maf_block(header, block):
+    return(
+        pl.read_csv(
+            header + block,
             has_header = True,
             separator = '\t',
             comment_prefix = '#',
-            dtypes = {
-                "Chromosome": pl.String,
-                "Tumor_Sample_Barcode": pl.String
-            }
+            infer_schema = False
         )
+    )
 
-    elif 'maf_data' in mafs:
-        maf_data = mafs['maf_data']
+# Subset maf file too large for memory to the panel, chunk by chunk
+# Each chunk is matched against the sorted intervals of the panel and
+# its overlapping rows are appended to `out_file` (tab-separated maf),
+# so memory is bounded by `chunk_size` (bytes of the file read at once)
+# rather than the size of the file. Matches keep the order of the file;
+# with `sort_chunks` they are sorted by chromosome and position within
+# every chunk instead
+def stream_overlaps(
+        file_path,
+        panel,
+        out_file,
+        chunk_size = 2**24,
+        columns = None,
+        snps_only = False,
+        samples = None,
+        sort_chunks = False,
+        metrics = None
+):
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    if not isinstance(panel, PanelIndex):
+        panel = PanelIndex.from_frame(panel)
 
-    else:
-        print('Neither file_path nor maf_data is provided!')
-        sys.exit('Please provide maf data as path to file or data frame')
+    with metrics.stage('overlap', message = 'Subsetting maf file to panel ...') as record, \
+            _atomic_write(out_file) as temporary, \
+            open(temporary, 'wb') as out:
+        rows = matches = 0
+        header = True
+        for chunk in read_maf_chunks(file_path, chunk_size = chunk_size):
+            rows += chunk.height
+            chunk = _subset_maf(
+                chunk.lazy(),
+                columns = columns,
+                snps_only = snps_only,
+                samples = samples
+            ).collect()
+            start, end = (
+                chunk[col].cast(pl.Int64, strict = False)
+                for col in ['Start_Position', 'End_Position']
+            )
+            mask = panel.overlaps(chunk['Chromosome'], start, end)
+            if sort_chunks:
+                order = panel.variant_keys(chunk['Chromosome'], start, end)[0]
+                chunk = chunk.filter(mask).sort(order.filter(mask))
+            else:
+                chunk = chunk.filter(mask)
+            chunk.write_csv(out, separator = '\t', include_header = header)
+            header = False
+            matches += chunk.height
+        record.update(rows = rows, matches = matches)
 
-    # Group by 'Tumor_Sample_Barcode' and split into polars DataFrames
-    maf_data_grouped = maf_data.group_by('Tumor_Sample_Barcode')
+    return(str(out_file))
 
-    ind_mafs = [group for _, group in maf_data_grouped]
+# Split multi-sample maf file to individual files
+# at user-specified location
+# `staging = 'maf'` or 'vcf' writes single-base substitutions only, in a
+# minimal maf or vcf; staged files are small enough to keep out_path on
+# a tmpfs such as /dev/shm
+def prepare_sbs_mafs(
+        out_path = str,
+        subset_to_panel = False,
+        panel = None,
+        lazy = False,
+        samples = None,
+        columns = sbs_maf_columns,
+        n_jobs = 4,
+        return_partitions = False,
+        staging = None,
+        metrics = None,
+        **mafs
+):
+    metrics = metrics if metrics is not None else PipelineMetrics()
 
-    Path(out_path).mkdir(parents = True, exist_ok = True)
+    with metrics.stage('preprocess', message = 'Preprocessing incoming maf file ...') as record:
+        maf_data = load_maf(
+            subset_to_panel = subset_to_panel,
+            panel = panel,
+            lazy = lazy,
+            samples = samples,
+            columns = columns,
+            n_jobs = n_jobs,
+            **mafs
+        )
+        if staging is not None:
+            maf_data = stage_sbs(maf_data, staging = staging)
+        record.update(rows = maf_data.height, bytes = maf_data.estimated_size())
 
-    for maf in ind_mafs:
-        if subset_to_panel:
-            maf = cool_overlaps(maf, panel)
-        save_maf(maf, out_path = out_path)
+    # Split by 'Tumor_Sample_Barcode' and write each sample to its own file
+    with metrics.stage('split', message = 'Writing per-sample maf files ...') as record:
+        ind_mafs = write_sample_mafs(
+            maf_data,
+            out_path = out_path,
+            n_jobs = n_jobs,
+            return_partitions = return_partitions,
+            metrics = metrics
+        )
+        record.update(rows = maf_data.height, samples = len(ind_mafs))
 
     return(ind_mafs)
 
 # Estimate exposure based on maf files
-from SigProfilerAssignment import Analyzer as Analyze
+# SigProfilerAssignment is slow to import, so it is only loaded on first fit
+def _analyzer():
+    from SigProfilerAssignment import Analyzer
+    return(Analyzer)
+
+_COSMIC_VERSION = 3.4
 
 def run_sigprofiler(
         incoming_data = str,
         out_path = str,
         genome_build = "GRCh37",
-        export_probabilities_per_mutation = True
+        export_probabilities_per_mutation = True,
+        n_shards = 1,
+        n_jobs = None,
+        backend = "sigprofiler",
+        signature_subset = None,
+        metrics = None
+):
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    if backend == "nnls":
+        message = 'Fitting signatures with NNLS ...'
+    elif n_shards > 1:
+        message = f'Running SigProfiler on {n_shards} shards ...'
+    else:
+        message = 'Running SigProfiler ...'
+    if isinstance(incoming_data, pl.DataFrame):
+        n_samples = incoming_data.width - 1
+    else:
+        n_samples = sum(1 for file in Path(incoming_data).iterdir() if file.is_file())
+
+    with metrics.stage('fit', message = message, samples = n_samples):
+        return(
+            _fit_activities(
+                incoming_data = incoming_data,
+                out_path = out_path,
+                genome_build = genome_build,
+                export_probabilities_per_mutation = export_probabilities_per_mutation,
+                n_shards = n_shards,
+                n_jobs = n_jobs,
+                backend = backend,
+                signature_subset = signature_subset
+            )
+        )
+
+def _fit_activities(
+        incoming_data = str,
+        out_path = str,
+        genome_build = "GRCh37",
+        export_probabilities_per_mutation = True,
+        n_shards = 1,
+        n_jobs = None,
+        backend = "sigprofiler",
+        signature_subset = None
 ):
-    print('Running SigProfiler ...')
-    Analyze.cosmic_fit(
+    if backend == "nnls":
+        return(
+            _run_nnls(
+                incoming_data = incoming_data,
+                out_path = out_path,
+                genome_build = genome_build,
+                signature_subset = signature_subset
+            )
+        )
+
+    if n_shards > 1:
+        return(
+            _run_sigprofiler_sharded(
+                incoming_data = incoming_data,
+                out_path = out_path,
+                genome_build = genome_build,
+                export_probabilities_per_mutation = export_probabilities_per_mutation,
+                n_shards = n_shards,
+                n_jobs = n_jobs
+            )
+        )
+
+    input_type = "vcf"
+    # SBS96 matrix built in-process, see `build_sbs96_matrix`
+    if isinstance(incoming_data, pl.DataFrame):
+        input_type = "matrix"
+        incoming_data = _write_matrix(
+            incoming_data,
+            pathlib.Path(out_path) / 'input' / 'sbs96_matrix.txt'
+        )
+        # Only available for vcf input
+        export_probabilities_per_mutation = False
+
+    _analyzer().cosmic_fit(
         samples = incoming_data,
         output = out_path,
-        input_type = "vcf",
+        input_type = input_type,
         context_type = "96",
         genome_build = genome_build,
-        cosmic_version = 3.4,
+        cosmic_version = _COSMIC_VERSION,
         export_probabilities_per_mutation = export_probabilities_per_mutation
     )
-    return()
+
+    return(_activities_file(out_path))
+
+def _write_matrix(
+        matrix,
+        path
+):
+    Path(path).parent.mkdir(parents = True, exist_ok = True)
+    matrix.write_csv(path, separator = '\t')
+    return(str(path))
+
+# Fit with the built-in NNLS backend instead of SigProfilerAssignment
+# Writes activities where SigProfiler would, so downstream steps are shared
+from .nnls_fit import fit_nnls_exposure
+def _run_nnls(
+        incoming_data,
+        out_path = str,
+        genome_build = "GRCh37",
+        signature_subset = None
+):
+    if not isinstance(incoming_data, pl.DataFrame):
+        raise ValueError(
+            'NNLS backend needs an SBS96 matrix, e.g. from build_sbs96_matrix'
+        )
+
+    activities = fit_nnls_exposure(
+        incoming_data,
+        genome_build = genome_build,
+        signature_subset = signature_subset
+    )
+
+    out_file = _activities_file(out_path)
+    Path(out_file).parent.mkdir(parents = True, exist_ok = True)
+    activities.write_csv(out_file, separator = '\t')
+
+    return(out_file)
+
+# Location of the activities table within SigProfiler output
+def _activities_file(out_path):
+    return(
+        str(
+            pathlib.Path(out_path) /
+            'Assignment_Solution' /
+            'Activities' /
+            'Assignment_Solution_Activities.txt'
+        )
+    )
+
+# Fit one shard, called in a separate worker process
+def _fit_shard(job):
+    shard_input, shard_output, input_type, genome_build, export_probabilities_per_mutation = job
+    _analyzer().cosmic_fit(
+        samples = shard_input,
+        output = shard_output,
+        input_type = input_type,
+        context_type = "96",
+        genome_build = genome_build,
+        cosmic_version = _COSMIC_VERSION,
+        export_probabilities_per_mutation = export_probabilities_per_mutation,
+        cpu = 1
+    )
+    return(shard_output)
+
+# Order signature columns as in the COSMIC reference, e.g. SBS7a < SBS10a
+import re
+def _signature_order(name):
+    match = re.match(r'([A-Za-z]+)(\d+)(.*)', name)
+    if match is None:
+        return(('', 0, name))
+    return((match.group(1), int(match.group(2)), match.group(3)))
+
+# Combine activities tables (files or data frames) into one
+# Each part only reports signatures active in its own samples,
+# missing ones are filled with 0 as in a single run
+def merge_activities(
+        files,
+        out_file = None
+):
+    activities = pl.concat(
+        [
+            file if isinstance(file, pl.DataFrame)
+            else pl.read_csv(
+                file,
+                separator = '\t',
+                schema_overrides = {'Samples': pl.String}
+            )
+            for file in files
+        ],
+        how = 'diagonal_relaxed'
+    ).fill_null(0)
+
+    signatures = sorted(
+        [col for col in activities.columns if col != 'Samples'],
+        key = _signature_order
+    )
+    activities = activities.select(['Samples'] + signatures).sort('Samples')
+
+    if out_file is not None:
+        Path(out_file).parent.mkdir(parents = True, exist_ok = True)
+        activities.write_csv(out_file, separator = '\t')
+
+    return(activities)
+
+# SigProfiler names samples of vcf input after their files, which are
+# sanitized and made unique by `write_sample_mafs`; put the sample ids back
+# `sample_files` maps the path of every written file to its sample id
+def _restore_sample_names(
+        activities_file,
+        sample_files
+):
+    sample_names = {
+        Path(path).stem: sample
+        for path, sample in sample_files.items()
+        if str(path).endswith('.vcf')
+    }
+    if not sample_names:
+        return(activities_file)
+    activities = merge_activities([activities_file])
+    merge_activities(
+        [activities.with_columns(pl.col('Samples').replace(sample_names))],
+        out_file = activities_file
+    )
+    return(activities_file)
+
+# Split per-sample files into shards and fit them in parallel processes
+# Each shard gets its own input and output directory under out_path/shards;
+# the merged results are written where a single run would put them
+def _run_sigprofiler_sharded(
+        incoming_data = str,
+        out_path = str,
+        genome_build = "GRCh37",
+        export_probabilities_per_mutation = True,
+        n_shards = 2,
+        n_jobs = None
+):
+    matrix_input = isinstance(incoming_data, pl.DataFrame)
+    if matrix_input:
+        files = incoming_data.columns[1:]
+        input_type = "matrix"
+        export_probabilities_per_mutation = False
+    else:
+        files = sorted(
+            file for file in pathlib.Path(incoming_data).iterdir()
+            if file.is_file() and not file.name.startswith('.')
+        )
+        input_type = "vcf"
+    n_shards = max(1, min(n_shards, len(files)))
+
+    jobs = []
+    for i in range(n_shards):
+        shard = pathlib.Path(out_path) / 'shards' / f'shard_{i}'
+        shard_input = shard / 'input'
+        shard_input.mkdir(parents = True, exist_ok = True)
+        # Round-robin keeps shard sizes balanced
+        if matrix_input:
+            shard_input = _write_matrix(
+                incoming_data.select(['MutationType'] + files[i::n_shards]),
+                shard_input / 'sbs96_matrix.txt'
+            )
+        else:
+            for file in files[i::n_shards]:
+                target = shard_input / file.name
+                if not target.exists():
+                    _link_or_copy(file, target)
+        jobs.append(
+            (
+                str(shard_input),
+                str(shard / 'output'),
+                input_type,
+                genome_build,
+                export_probabilities_per_mutation
+            )
+        )
+
+    with _spawn_pool(n_jobs or n_shards) as pool:
+        outputs = list(pool.map(_fit_shard, jobs))
+
+    out_file = _activities_file(out_path)
+    merge_activities(
+        [_activities_file(output) for output in outputs],
+        out_file = out_file
+    )
+
+    # Per-mutation probabilities are already one file per sample
+    if export_probabilities_per_mutation:
+        merged = pathlib.Path(out_file).parent / 'Decomposed_Mutation_Probabilities'
+        merged.mkdir(parents = True, exist_ok = True)
+        for output in outputs:
+            for file in pathlib.Path(output).glob(
+                '**/Decomposed_Mutation_Probabilities_*.txt'
+            ):
+                shutil.move(str(file), str(merged / file.name))
+
+    return(out_file)
+
+# Keys shared by maf rows and SigProfiler's per-mutation probabilities
+# SigProfiler names samples by barcode (maf input) or file name (vcf),
+# writes chromosomes without a `chr` prefix and gives substitutions on
+# the pyrimidine strand; the flanking bases of the context need the
+# reference genome, so substitution, not full context, is matched
+def _sample_key(col):
+    return(
+        pl.col(col).cast(pl.String)
+        .str.replace_all(r'[^A-Za-z0-9_-]+', '_')
+        .str.strip_chars('_')
+        .alias('_sample')
+    )
+
+def _chromosome_key(col):
+    return(pl.col(col).cast(pl.String).str.replace(r'^chr', '').alias('_chrom'))
+
+def _substitution_key(ref_col, alt_col):
+    ref = pl.col(ref_col).cast(pl.String).str.to_uppercase()
+    alt = pl.col(alt_col).cast(pl.String).str.to_uppercase()
+    bases = ['A', 'C', 'G', 'T']
+    complement = ['T', 'G', 'C', 'A']
+    return(
+        pl.when(ref.is_in(['A', 'G'])).then(
+            ref.str.replace_many(bases, complement) + '>' +
+            alt.str.replace_many(bases, complement)
+        ).otherwise(
+            ref + '>' + alt
+        ).alias('_substitution')
+    )
+
+_probability_keys = ['_sample', '_chrom', '_position', '_substitution']
+
+# Per-mutation probabilities of one file with keys and all `signatures`
+# Signatures not in the file had no exposure in its sample
+def _scan_probabilities(file, signatures):
+    with open(file) as header:
+        columns = header.readline().rstrip('\n').split('\t')
+    return(
+        pl.scan_csv(
+            file,
+            separator = '\t',
+            schema_overrides = {
+                'Sample Names': pl.String,
+                'Chr': pl.String,
+                'Pos': pl.Int64,
+                'MutationType': pl.String
+            }
+        ).select(
+            _sample_key('Sample Names'),
+            _chromosome_key('Chr'),
+            pl.col('Pos').alias('_position'),
+            pl.col('MutationType').str.slice(2, 3).alias('_substitution'),
+            pl.col('MutationType'),
+            *[
+                pl.col(col).cast(pl.Float64) if col in columns
+                else pl.lit(0.0).alias(col)
+                for col in signatures
+            ]
+        )
+    )
+
+# Join SigProfiler's per-mutation signature probabilities to maf rows
+# Decomposed_Mutation_Probabilities_*.txt files below `probabilities_path`
+# are taken in batches of about `chunk_size` bytes and joined to the maf
+# rows of their samples by sample, chromosome, position and substitution.
+# Every batch is written to its own parquet file and the batches are
+# then streamed into `out_file`, so memory is bounded by the batch, not
+# the cohort. Rows gain the SBS96 `MutationType`, one probability column
+# per signature and `Most_Likely_Signature`, and follow the maf order
+# within each batch. Maf rows without probabilities (e.g. indels) are
+# dropped unless `how = 'left'`. A maf file is scanned once per batch;
+# with `maf_cache` (see `load_maf`) these scans read the typed copy
+def join_mutation_probabilities(
+        probabilities_path,
+        out_file,
+        how = 'inner',
+        chunk_size = 2**28,
+        maf_cache = None,
+        **mafs
+):
+    files = sorted(
+        pathlib.Path(probabilities_path).glob('**/Decomposed_Mutation_Probabilities_*.txt')
+    )
+    if not files:
+        raise FileNotFoundError(f'No per-mutation probabilities found in {probabilities_path}')
+
+    if maf_cache is not None and 'file_path' in mafs:
+        mafs = {'maf_data': _load_cached_mafs(maf_cache, mafs['file_path'], lazy = True)}
+    if 'file_path' in mafs:
+        maf_data = scan_maf(mafs['file_path'], columns = None, snps_only = False)
+    elif 'maf_data' in mafs:
+        maf_data = mafs['maf_data'].lazy()
+    else:
+        raise ValueError('Please provide maf data as file_path or maf_data')
+
+    # Every file holds one sample, named after it like SigProfiler does
+    signatures = set()
+    for file in files:
+        with open(file) as header:
+            signatures.update(header.readline().rstrip('\n').split('\t')[4:])
+    signatures = sorted(signatures, key = _signature_order)
+    sample_names = [
+        sanitize_sample_name(file.stem[len('Decomposed_Mutation_Probabilities_'):])
+        for file in files
+    ]
+    # Barcodes of each file name, so batches filter on the raw column
+    barcodes = {}
+    for barcode in maf_data.select(
+        pl.col('Tumor_Sample_Barcode').cast(pl.String).unique()
+    ).collect(engine = 'streaming').to_series():
+        barcodes.setdefault(sanitize_sample_name(barcode), []).append(barcode)
+
+    batches = [[]]
+    size = 0
+    for file, sample in zip(files, sample_names):
+        if batches[-1] and size + file.stat().st_size > chunk_size:
+            batches.append([])
+            size = 0
+        batches[-1].append((file, sample))
+        size += file.stat().st_size
+
+    parts_path = pathlib.Path(f'{out_file}.parts')
+    shutil.rmtree(parts_path, ignore_errors = True)
+    parts_path.mkdir(parents = True)
+    try:
+        parts = []
+        for i, batch in enumerate(batches):
+            probabilities = pl.concat(
+                [_scan_probabilities(file, signatures) for file, _ in batch]
+            ).collect()
+            probabilities = probabilities.with_columns(
+                Most_Likely_Signature = pl.Series(signatures).gather(
+                    np.argmax(probabilities.select(signatures).to_numpy(), axis = 1)
+                )
+            )
+            samples = [sample for _, sample in batch]
+            # Maf rows of samples without probabilities go with the last batch
+            if how == 'left' and i == len(batches) - 1:
+                samples += [sample for sample in barcodes if sample not in set(sample_names)]
+            selected = [barcode for sample in samples for barcode in barcodes.get(sample, [])]
+            part = maf_data.filter(
+                pl.col('Tumor_Sample_Barcode').cast(pl.String).is_in(selected)
+            ).with_columns(
+                _sample_key('Tumor_Sample_Barcode'),
+                _chromosome_key('Chromosome'),
+                pl.col('Start_Position').cast(pl.Int64).alias('_position'),
+                _substitution_key('Reference_Allele', 'Tumor_Seq_Allele2')
+            ).join(
+                probabilities.lazy(),
+                on = _probability_keys,
+                how = how,
+                maintain_order = 'left'
+            ).drop(
+                _probability_keys
+            ).collect(engine = 'streaming')
+            parts.append(parts_path / f'part_{i:05d}.parquet')
+            part.write_parquet(parts[-1], compression = 'uncompressed')
+            del part
+
+        pl.scan_parquet(parts).sink_parquet(out_file)
+    finally:
+        shutil.rmtree(parts_path, ignore_errors = True)
+
+    return(str(out_file))
 
 # Normalize signature exposure to be relative/sample
+# Accepts path to the Activities file or an activities data frame
+# All numeric columns are divided by their row sum in one lazy pass;
+# samples without any exposure are kept with all values set to 0
 import polars.selectors as cs
 def scale_sbs_exposure(
-        file_path = str
+        file_path = str,
+        out_file = None,
+        float32 = False,
+        metrics = None
 ):
-    print('Scaling SBS exposure per sample ...')
-    activities = pl.read_csv(
-        source = file_path,
-        has_header = True,
-        separator = "\t",
-        dtypes = {
-            'Samples' : pl.String
-        }
-    )
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    with metrics.stage('scale', message = 'Scaling SBS exposure per sample ...') as record:
+        activities = _scale_activities(file_path, out_file = out_file, float32 = float32)
+        record.update(rows = activities.height, bytes = activities.estimated_size())
+    return(activities)
 
-    # Calculate sum of numeric columns horizontally
-    # Store the sum in temp column `row_sum`
-    activities = activities.with_columns(
-        activities.select(
-            cs.integer()
-        ).sum(
-            axis = 1
-        ).alias(
-            'row_sum'
+def _scale_activities(
+        file_path = str,
+        out_file = None,
+        float32 = False
+):
+    if isinstance(file_path, pl.DataFrame):
+        activities = file_path.lazy()
+    elif isinstance(file_path, pl.LazyFrame):
+        activities = file_path
+    else:
+        activities = pl.scan_csv(
+            source = file_path,
+            has_header = True,
+            separator = "\t",
+            schema_overrides = {
+                'Samples' : pl.String
+            }
         )
-    )
 
-    # List of column names
-    numeric_cols = activities.select(cs.integer()).columns
+    row_sum = pl.sum_horizontal(cs.numeric())
+    scaled = pl.when(
+        row_sum > 0
+    ).then(
+        cs.numeric() / row_sum
+    ).otherwise(
+        pl.lit(0.0)
+    )
+    if float32:
+        scaled = scaled.cast(pl.Float32)
 
-    # Scale numeric values horizontally
-    activities[numeric_cols] = activities[numeric_cols] / activities['row_sum']
+    activities = activities.with_columns(scaled).collect()
 
-    # Drop the temp column
-    activities = activities.select(pl.col('*').exclude('row_sum'))
+    # Optionally keep the scaled table as parquet
+    if out_file is not None:
+        activities.write_parquet(out_file)
 
     return(activities)
 
@@ -125,28 +1030,206 @@ def select_represented_sbs(
         threshold = 0.1
 ):
     # Only select columns with SBS data
-    filtered = (
-        input_data
-        .select([col for col in input_data.columns if 'SBS' in col])
-    )
+    sbs_columns = [col for col in input_data.columns if 'SBS' in col]
+    if not sbs_columns:
+        return(input_data.select('Samples'))
 
-    # Which SBS columns are not all 0s?
-    sum_non_zero = filtered.select(pl.all().map(non_zero_percentage))
+    # Number of samples with non-0 SBS, in one aggregation
+    sum_non_zero = input_data.select(
+        (pl.col(sbs_columns) > 0).sum()
+    ).row(0, named = True)
 
     # Only keep columns where there is at least X samples with non-0 SBS
-    represented = sum_non_zero > (len(filtered) * threshold)
+    columns = [
+        col for col in sbs_columns
+        if sum_non_zero[col] > (len(input_data) * threshold)
+    ]
 
-    columns = [col for col in represented.columns if represented[col][0] == True]
+    # Add back the sample ids
+    selected = input_data.select(['Samples'] + columns)
 
-    represented = filtered[columns]
+    return(selected)
 
-    # Add back the sample ids
-    selected = represented.insert_at_idx(0, input_data['Samples'])
+# Prevalence of every signature for many thresholds and subgroups at once
+# Non-zero counts are aggregated once per group; thresholds only compare
+# against the aggregate, so trying new cutoffs costs nothing
+def sbs_prevalence(
+        input_data,
+        thresholds = (0.01, 0.05, 0.1, 0.2, 0.5),
+        group_by = None
+):
+    sbs_columns = [col for col in input_data.columns if 'SBS' in col]
+    groups = [] if group_by is None else (
+        [group_by] if isinstance(group_by, str) else list(group_by)
+    )
+    aggregations = [pl.len().alias('n_samples')] + [
+        (pl.col(col) > 0).sum().alias(col) for col in sbs_columns
+    ]
 
-    return(represented)
+    if groups:
+        counts = input_data.group_by(groups, maintain_order = True).agg(aggregations)
+    else:
+        counts = input_data.select(aggregations)
+
+    prevalence = counts.unpivot(
+        index = groups + ['n_samples'],
+        on = sbs_columns,
+        variable_name = 'signature',
+        value_name = 'n_non_zero'
+    ).with_columns(
+        prevalence = pl.col('n_non_zero') / pl.col('n_samples')
+    ).join(
+        pl.DataFrame({'threshold': list(thresholds)}, schema = {'threshold': pl.Float64}),
+        how = 'cross'
+    ).with_columns(
+        # Same rule as `select_represented_sbs`
+        represented = pl.col('n_non_zero') > pl.col('n_samples') * pl.col('threshold')
+    )
+
+    return(prevalence)
 
-import shutil
 from .helpers import *
+from .exposure_cache import ExposureCache
+from .sbs_matrix import build_sbs96_matrix
+
+# Fit loaded maf data, either through per-sample files or, when a
+# reference fasta is given, through an SBS96 matrix built in-process
+def _fit_samples(
+        maf_data,
+        out_path = str,
+        genome_build = "GRCh37",
+        export_probabilities_per_mutation = True,
+        n_shards = 1,
+        n_jobs = None,
+        reference_fasta = None,
+        backend = "sigprofiler",
+        signature_subset = None,
+        staging = None,
+        staging_dir = None,
+        metrics = None
+):
+    if backend == "nnls" and reference_fasta is None:
+        raise ValueError('NNLS backend needs reference_fasta to build the SBS96 matrix')
+
+    staged_path = None
+    with metrics.stage('split') as record:
+        if reference_fasta is not None:
+            incoming_data = build_sbs96_matrix(maf_data, reference_fasta, metrics = metrics)
+            record.update(bytes = incoming_data.estimated_size())
+        else:
+            # Per-sample files can go elsewhere, e.g. to a tmpfs
+            if staging_dir is not None:
+                Path(staging_dir).mkdir(parents = True, exist_ok = True)
+                staged_path = tempfile.mkdtemp(prefix = 'lymphgenerator_', dir = staging_dir)
+            written = write_sample_mafs(
+                maf_data,
+                out_path = staged_path or out_path,
+                n_jobs = n_jobs or 4,
+                return_names = True,
+                staging = staging,
+                metrics = metrics
+            )
+            incoming_data = staged_path or out_path
+        record.update(rows = maf_data.height)
+
+    try:
+        activities_file = run_sigprofiler(
+            incoming_data = incoming_data,
+            out_path = out_path,
+            genome_build = genome_build,
+            export_probabilities_per_mutation = export_probabilities_per_mutation,
+            n_shards = n_shards,
+            n_jobs = n_jobs,
+            backend = backend,
+            signature_subset = signature_subset,
+            metrics = metrics
+        )
+    finally:
+        if staged_path is not None:
+            shutil.rmtree(staged_path, ignore_errors = True)
+
+    if reference_fasta is None:
+        _restore_sample_names(activities_file, written)
+    return(activities_file)
+
+# Fit only samples missing from the cache and merge with cached results
+# Returns path to the combined (unscaled) activities table
+def _run_sigprofiler_cached(
+        maf_data,
+        cache,
+        out_path = str,
+        genome_build = "GRCh37",
+        panel = None,
+        export_probabilities_per_mutation = True,
+        n_shards = 1,
+        n_jobs = None,
+        reference_fasta = None,
+        backend = "sigprofiler",
+        signature_subset = None,
+        staging = None,
+        staging_dir = None,
+        metrics = None
+):
+    if not isinstance(cache, ExposureCache):
+        cache = ExposureCache(cache)
+
+    method = backend
+    if signature_subset is not None:
+        method += '|' + ','.join(sorted(signature_subset))
+    keys = cache.keys(
+        maf_data,
+        genome_build = genome_build,
+        cosmic_version = _COSMIC_VERSION,
+        panel = panel,
+        method = method
+    )
+
+    cached = []
+    missing = []
+    for sample, key in keys.iter_rows():
+        activities = cache.get(key, sample = sample)
+        if activities is None:
+            missing.append(sample)
+        else:
+            cached.append(activities)
+    metrics.message(f'Using cached exposure for {len(cached)} samples, fitting {len(missing)} ...')
+
+    fitted = []
+    if missing:
+        # Stage new samples separately from any earlier outputs
+        fit_path = str(pathlib.Path(out_path) / 'uncached')
+        shutil.rmtree(fit_path, ignore_errors = True)
+        fitted_file = _fit_samples(
+            maf_data.filter(
+                pl.col('Tumor_Sample_Barcode').is_in(missing)
+            ),
+            out_path = fit_path,
+            genome_build = genome_build,
+            export_probabilities_per_mutation = export_probabilities_per_mutation,
+            n_shards = n_shards,
+            n_jobs = n_jobs,
+            reference_fasta = reference_fasta,
+            backend = backend,
+            signature_subset = signature_subset,
+            staging = staging,
+            staging_dir = staging_dir,
+            metrics = metrics
+        )
+        fitted = [merge_activities([fitted_file])]
+
+        # Store every newly fitted sample under its own key
+        new_keys = dict(keys.iter_rows())
+        for row in fitted[0].partition_by('Samples'):
+            key = new_keys.get(row['Samples'][0])
+            if key is not None:
+                cache.put(key, row)
+        cache.evict()
+
+    out_file = _activities_file(out_path)
+    merge_activities(cached + fitted, out_file = out_file)
+
+    return(out_file)
+
 def estimate_sbs_exposure(
         out_path = str,
         genome_build = "GRCh37",
@@ -154,26 +1237,105 @@ def estimate_sbs_exposure(
         subset_to_panel = False,
         panel = None,
         export_probabilities_per_mutation = True,
+        n_shards = 1,
+        n_jobs = None,
+        cache = None,
+        reference_fasta = None,
+        backend = "sigprofiler",
+        signature_subset = None,
+        staging = None,
+        staging_dir = None,
+        probabilities_file = None,
+        metrics = None,
+        return_metrics = False,
         **mafs
 ):
-    preprocess = prepare_sbs_mafs(
-        out_path = out_path,
-        subset_to_panel = subset_to_panel,
-        panel = panel,
-        **mafs
-    )
-    estimate = run_sigprofiler(
-        incoming_data = out_path,
-        out_path = out_path,
-        genome_build = genome_build,
-        export_probabilities_per_mutation = export_probabilities_per_mutation
-    )
-    input_file = sorted(pathlib.Path(out_path).glob('**/*_Activities.txt'))
+    """
+    Estimate relative SBS exposure of every sample in maf data.
+
+    Progress, timing and memory of every stage go to `metrics`, a
+    `PipelineMetrics` (printed by default). With `return_metrics = True`
+    its report is returned together with the activities. With
+    `staging = 'maf'` or 'vcf' only single-base substitutions are written
+    for SigProfiler, in a minimal maf or vcf (see `stage_sbs`), and
+    `staging_dir` moves these files out of `out_path`, e.g. to a tmpfs.
+    With `probabilities_file`, per-mutation signature probabilities are
+    joined to the maf rows and written there as parquet before the
+    outputs are cleared, see `join_mutation_probabilities`; with a
+    `cache`, only newly fitted samples have them, and no file is written
+    when every sample was cached.
+    """
+
+    if probabilities_file is not None and (
+            not export_probabilities_per_mutation or reference_fasta is not None):
+        raise ValueError(
+            'Per-mutation probabilities need export_probabilities_per_mutation '
+            'and per-sample input, i.e. no reference_fasta'
+        )
+
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    with metrics.stage('preprocess', message = 'Preprocessing incoming maf file ...') as record:
+        maf_data = load_maf(
+            subset_to_panel = subset_to_panel,
+            panel = panel,
+            **mafs
+        )
+        record.update(rows = maf_data.height, bytes = maf_data.estimated_size())
+
+    if cache is not None:
+        # Only new or changed samples are refit
+        input_file = _run_sigprofiler_cached(
+            maf_data,
+            cache,
+            out_path = out_path,
+            genome_build = genome_build,
+            panel = panel if subset_to_panel else None,
+            export_probabilities_per_mutation = export_probabilities_per_mutation,
+            n_shards = n_shards,
+            n_jobs = n_jobs,
+            reference_fasta = reference_fasta,
+            backend = backend,
+            signature_subset = signature_subset,
+            staging = staging,
+            staging_dir = staging_dir,
+            metrics = metrics
+        )
+
+    else:
+        input_file = _fit_samples(
+            maf_data,
+            out_path = out_path,
+            genome_build = genome_build,
+            export_probabilities_per_mutation = export_probabilities_per_mutation,
+            n_shards = n_shards,
+            n_jobs = n_jobs,
+            reference_fasta = reference_fasta,
+            backend = backend,
+            signature_subset = signature_subset,
+            staging = staging,
+            staging_dir = staging_dir,
+            metrics = metrics
+        )
     activities = scale_sbs_exposure(
-        file_path = str(input_file[0])
+        file_path = input_file,
+        metrics = metrics
     )
 
+    # With a cache, only samples fitted in this run have probabilities
+    if probabilities_file is not None and cache is not None and not any(
+            Path(out_path).glob('**/Decomposed_Mutation_Probabilities_*.txt')):
+        metrics.message('All samples were cached, no per-mutation probabilities to join')
+    elif probabilities_file is not None:
+        with metrics.stage('probabilities', message = 'Joining per-mutation probabilities ...'):
+            join_mutation_probabilities(
+                out_path,
+                probabilities_file,
+                maf_data = maf_data
+            )
+
     if clear_temp_outputs:
         shutil.rmtree(out_path, ignore_errors = True)
 
+    if return_metrics:
+        return(activities, metrics.report())
     return(activities)
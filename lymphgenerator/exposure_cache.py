@@ -0,0 +1,135 @@
+import polars as pl
+from pathlib import Path
+import hashlib
+import os
+from .helpers import PanelIndex
+
+# Variant fields that define the SBS input of a sample
+_sbs_key_columns = [
+    "Chromosome", "Start_Position", "Reference_Allele", "Tumor_Seq_Allele2"
+]
+
+# Stable hash of data frame content, independent of row order
+def _frame_digest(df):
+    csv = df.select(
+        pl.all().cast(pl.String)
+    ).sort(
+        pl.all()
+    ).write_csv(
+        separator = '\t'
+    )
+    return(hashlib.sha256(csv.encode()).hexdigest())
+
+class ExposureCache:
+    """
+    Persistent on-disk cache of per-sample SigProfiler activities.
+
+    Entries are keyed on a hash of the sample's SBS variants together with
+    genome build, COSMIC version and panel, so the same variants fitted
+    under the same settings are never refit. Sample names are not part of
+    the key. Least recently used entries are evicted once the cache grows
+    beyond max_size bytes.
+    """
+
+    def __init__(
+            self,
+            cache_dir,
+            max_size = 1e9
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+        self.max_size = max_size
+
+    def _path(self, key):
+        return(self.cache_dir / f'{key}.parquet')
+
+    # Key every sample of the maf
+    # Returns a data frame with `Tumor_Sample_Barcode` and `key` columns
+    def keys(
+            self,
+            maf_data,
+            genome_build = "GRCh37",
+            cosmic_version = 3.4,
+            panel = None,
+            method = "sigprofiler"
+    ):
+        settings = f'{genome_build}|{cosmic_version}|{method}|'
+        if isinstance(panel, PanelIndex):
+            panel = panel.to_frame()
+        if panel is not None:
+            settings += _frame_digest(panel)
+
+        snvs = maf_data.filter(
+            pl.col('Variant_Type') == 'SNP'
+        ).select(
+            ['Tumor_Sample_Barcode'] + _sbs_key_columns
+        )
+
+        keys = []
+        for (sample, ), variants in snvs.group_by(
+            'Tumor_Sample_Barcode',
+            maintain_order = True
+        ):
+            digest = hashlib.sha256(
+                (settings + _frame_digest(variants.drop('Tumor_Sample_Barcode'))).encode()
+            ).hexdigest()
+            keys.append([sample, digest])
+
+        return(
+            pl.DataFrame(
+                keys,
+                schema = ['Tumor_Sample_Barcode', 'key'],
+                orient = 'row'
+            )
+        )
+
+    # Cached activities of one entry, renamed to the requested sample
+    def get(
+            self,
+            key,
+            sample = None
+    ):
+        path = self._path(key)
+        if not path.exists():
+            return None
+        # Touch the entry to keep track of recent use
+        os.utime(path)
+        activities = pl.read_parquet(path)
+        if sample is not None:
+            activities = activities.with_columns(Samples = pl.lit(sample))
+        return(activities)
+
+    def put(
+            self,
+            key,
+            activities
+    ):
+        activities.write_parquet(self._path(key))
+
+    def size(self):
+        return(sum(path.stat().st_size for path in self.cache_dir.glob('*.parquet')))
+
+    # Remove least recently used entries until the cache fits max_size
+    def evict(self):
+        entries = sorted(
+            self.cache_dir.glob('*.parquet'),
+            key = lambda path: path.stat().st_mtime
+        )
+        total = sum(path.stat().st_size for path in entries)
+        for path in entries:
+            if total <= self.max_size:
+                break
+            total -= path.stat().st_size
+            path.unlink(missing_ok = True)
+
+    # Drop given keys, or the whole cache if no keys are given
+    def invalidate(
+            self,
+            keys = None
+    ):
+        if keys is None:
+            paths = list(self.cache_dir.glob('*.parquet'))
+        else:
+            paths = [self._path(key) for key in keys]
+        for path in paths:
+            path.unlink(missing_ok = True)
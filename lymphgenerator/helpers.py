@@ -3,6 +3,78 @@ def non_zero_percentage(col):
     return col.filter(col > 0).count()
 
 import polars as pl
+import numpy as np
+
+# Offset used to place every chromosome on its own stretch of a single
+# sorted coordinate axis. Larger than any chromosome length in GRCh37/38
+_CHROM_OFFSET = 2 ** 32
+
+# Build the sorted interval keys for the panel once
+# Each chromosome gets a rank and every coordinate is shifted by
+# rank * _CHROM_OFFSET, so a single binary search covers all chromosomes
+def _interval_keys(
+        df2,
+        col_name2 = 'chrom',
+        start_name2 = 'start',
+        end_name2 = 'end'
+):
+    panel = df2.select(
+        [col_name2, start_name2, end_name2]
+    ).drop_nulls()
+    chromosomes = panel[col_name2].unique().sort()
+    ranks = pl.Series(range(len(chromosomes)), dtype = pl.Int64)
+
+    rank = panel[col_name2].replace_strict(
+        chromosomes,
+        ranks,
+        return_dtype = pl.Int64
+    ).to_numpy()
+    starts = np.sort(
+        rank * _CHROM_OFFSET + panel[start_name2].cast(pl.Int64).to_numpy()
+    )
+    ends = np.sort(
+        rank * _CHROM_OFFSET + panel[end_name2].cast(pl.Int64).to_numpy()
+    )
+
+    return(chromosomes, ranks, starts, ends)
+
+# Expression counting how many panel intervals overlap every variant
+# Intervals are closed on both sides, i.e. the variant overlaps when
+# start1 <= end2 and end1 >= start2. Assuming start <= end for both tables,
+# this is (# intervals with start2 <= end1) - (# intervals with end2 < start1)
+# which is two binary searches per variant instead of a cross join
+def _overlap_count(
+        keys,
+        col_name1 = 'Chromosome',
+        start_name1 = 'Start_Position',
+        end_name1 = 'End_Position'
+):
+    chromosomes, ranks, starts, ends = keys
+    offset = pl.col(col_name1).cast(pl.String).replace_strict(
+        chromosomes,
+        ranks,
+        default = None,
+        return_dtype = pl.Int64
+    ) * _CHROM_OFFSET
+    n_started = pl.lit(pl.Series(starts, dtype = pl.Int64)).search_sorted(
+        offset + pl.col(end_name1).cast(pl.Int64),
+        side = 'right'
+    ).cast(pl.Int64)
+    n_ended = pl.lit(pl.Series(ends, dtype = pl.Int64)).search_sorted(
+        offset + pl.col(start_name1).cast(pl.Int64),
+        side = 'left'
+    ).cast(pl.Int64)
+
+    return(
+        pl.when(
+            offset.is_not_null() &
+            pl.col(start_name1).is_not_null() &
+            pl.col(end_name1).is_not_null()
+        ).then(n_started - n_ended)
+        .otherwise(0)
+        .clip(lower_bound = 0)
+    )
+
 def cool_overlaps(
         df1,
         df2,
@@ -13,47 +85,334 @@ def cool_overlaps(
         start_name2 = 'start',
         end_name2 = 'end'
 ):
+    """
+    Subset df1 (e.g. maf) to rows overlapping any interval in df2 (e.g. bed).
 
-    # Ensure the kernel is not killed for large mafs
-    # Use arbitrary cutoff of 50k variants
-    if df1.shape[0] > 5e4:
-        chromosomes = df1[col_name1].unique().to_list()
-        chromosomes.sort()
-        result_df = pl.DataFrame()
-        for chromosome in chromosomes:
-            small_maf = df1.filter(pl.col(col_name1) == chromosome)
-            small_panel = df2.filter(pl.col(col_name2) == chromosome)
-            overlap = small_maf.join(
-                small_panel,
-                left_on = col_name1,
-                right_on = col_name2
-            )
-
-            overlap = overlap.filter(
-                (overlap[start_name1] <= overlap[end_name2]) &
-                (overlap[end_name1] >= overlap[start_name2])
-            )
-
-            overlap = overlap[small_maf.columns]
-            result_df = pl.concat([result_df, overlap])
-
-            return(result_df)
-
-    result_df = df1.join(
-        df2,
-        left_on = col_name1,
-        right_on = col_name2
-    )
+    Works on sorted interval keys with binary search, so no cross product of
+    variants and intervals is ever built. Rows of df1 are returned in their
+    original order and, as with a join, once per overlapping interval.
+    Both df1 and df2 can be eager or lazy; the result follows df1.
+    df2 can also be a `PanelIndex`, whose intervals are merged, so every
+    overlapping row of df1 is then returned exactly once.
+    """
 
-    overlap = result_df.filter(
-        (result_df[start_name1] <= result_df[end_name2]) &
-        (result_df[end_name1] >= result_df[start_name2])
+    if isinstance(df2, PanelIndex):
+        keys = df2.keys()
+    else:
+        if isinstance(df2, pl.LazyFrame):
+            df2 = df2.collect()
+        keys = _interval_keys(
+            df2,
+            col_name2 = col_name2,
+            start_name2 = start_name2,
+            end_name2 = end_name2
+        )
+    columns = df1.collect_schema().names()
+
+    overlap = df1.with_columns(
+        _overlap_count(
+            keys,
+            col_name1 = col_name1,
+            start_name1 = start_name1,
+            end_name1 = end_name1
+        ).alias('_n_overlaps')
+    ).filter(
+        pl.col('_n_overlaps') > 0
     )
+    # Merged intervals never overlap each other, so no row is repeated
+    if isinstance(df2, PanelIndex):
+        return(overlap.select(columns))
 
-    overlap = overlap[df1.columns]
+    overlap = overlap.with_columns(
+        # Repeat each row once per overlapping interval
+        pl.int_ranges(0, pl.col('_n_overlaps')).alias('_n_overlaps')
+    ).explode(
+        '_n_overlaps',
+        empty_as_null = False
+    ).select(
+        columns
+    )
 
     return(overlap)
 
+class PanelIndex:
+    """
+    Panel of regions prepared once for repeated overlap queries.
+
+    Overlapping and adjacent intervals are merged and the result is kept
+    as sorted start and end arrays per chromosome. Because intervals are
+    merged, subsetting with an index returns every overlapping variant
+    once, while a raw panel with overlapping intervals repeats the
+    variant once per interval. The index can be saved to an Arrow IPC
+    file and loaded again memory-mapped. Accepted wherever `cool_overlaps`,
+    `load_maf` or `prepare_sbs_mafs` take a panel.
+    """
+
+    def __init__(
+            self,
+            intervals
+    ):
+        # Merged intervals as `chrom`, `start`, `end`, sorted by chromosome
+        # and start, as made by `from_frame` or read by `load`
+        self.intervals = intervals
+        self.chromosomes = intervals['chrom'].unique(maintain_order = True)
+        self.ranks = pl.Series(range(len(self.chromosomes)), dtype = pl.Int64)
+        rank = intervals['chrom'].replace_strict(
+            self.chromosomes,
+            self.ranks,
+            return_dtype = pl.Int64
+        ).to_numpy()
+        self.starts = rank * _CHROM_OFFSET + intervals['start'].to_numpy()
+        self.ends = rank * _CHROM_OFFSET + intervals['end'].to_numpy()
+        # Where every chromosome begins in the interval arrays
+        self.offsets = np.searchsorted(
+            self.starts,
+            np.arange(len(self.chromosomes) + 1) * _CHROM_OFFSET
+        )
+
+    @classmethod
+    def from_frame(
+            cls,
+            panel,
+            col_name = 'chrom',
+            start_name = 'start',
+            end_name = 'end'
+    ):
+        if isinstance(panel, pl.LazyFrame):
+            panel = panel.collect()
+        panel = panel.select(
+            pl.col(col_name).cast(pl.String).alias('chrom'),
+            pl.col(start_name).cast(pl.Int64).alias('start'),
+            pl.col(end_name).cast(pl.Int64).alias('end')
+        ).drop_nulls()
+        chromosomes = panel['chrom'].unique().sort()
+
+        merged = panel.with_columns(
+            _rank = pl.col('chrom').replace_strict(chromosomes, range(len(chromosomes)))
+        ).sort(
+            ['_rank', 'start']
+        ).with_columns(
+            _max_end = pl.col('end').cum_max().over('_rank')
+        ).with_columns(
+            # A new interval starts past the end of everything before it
+            _group = (
+                pl.col('start') > pl.col('_max_end').shift(1).over('_rank') + 1
+            ).fill_null(True).cum_sum()
+        ).group_by(
+            '_group',
+            maintain_order = True
+        ).agg(
+            pl.col('chrom').first(),
+            pl.col('start').first(),
+            pl.col('end').max()
+        ).drop('_group')
+
+        return(cls(merged))
+
+    @classmethod
+    def from_bed(cls, file_path):
+        return(cls.from_frame(read_panel(file_path)))
+
+    @classmethod
+    def load(cls, file_path):
+        return(cls(pl.read_ipc(file_path, memory_map = True)))
+
+    def save(self, file_path):
+        self.intervals.write_ipc(file_path, compression = 'uncompressed')
+        return(file_path)
+
+    # Sorted starts and ends of one chromosome
+    def chromosome_intervals(self, chromosome):
+        matches = (self.chromosomes == str(chromosome)).arg_true()
+        if len(matches) == 0:
+            empty = np.array([], dtype = np.int64)
+            return(empty, empty)
+        i = matches[0]
+        first, last = self.offsets[i], self.offsets[i + 1]
+        return(
+            self.starts[first:last] - i * _CHROM_OFFSET,
+            self.ends[first:last] - i * _CHROM_OFFSET
+        )
+
+    # Positions of variants on the coordinate axis of the index
+    # Variants on chromosomes outside of the panel get null
+    def variant_keys(self, chromosome, start, end):
+        offset = chromosome.cast(pl.String).replace_strict(
+            self.chromosomes,
+            self.ranks,
+            default = None,
+            return_dtype = pl.Int64
+        ) * _CHROM_OFFSET
+        return(offset + start.cast(pl.Int64), offset + end.cast(pl.Int64))
+
+    # Boolean mask of variants overlapping the panel
+    # Merged intervals are disjoint, so the only candidate for a variant is
+    # the last interval starting at or before its end. Only the stretch of
+    # intervals between the lowest and highest variant is searched, which
+    # for sorted chunks of a file is a merge of both sorted lists
+    def overlaps(self, chromosome, start, end):
+        start_keys, end_keys = self.variant_keys(chromosome, start, end)
+        valid = (start_keys.is_not_null() & end_keys.is_not_null()).to_numpy()
+        mask = np.zeros(len(valid), dtype = bool)
+        if not valid.any():
+            return(mask)
+        start_keys = start_keys.to_numpy()[valid].astype(np.int64)
+        end_keys = end_keys.to_numpy()[valid].astype(np.int64)
+
+        first = np.searchsorted(self.ends, start_keys.min(), side = 'left')
+        last = np.searchsorted(self.starts, end_keys.max(), side = 'right')
+        starts = self.starts[first:last]
+        ends = self.ends[first:last]
+        candidate = np.searchsorted(starts, end_keys, side = 'right') - 1
+        hit = candidate >= 0
+        hit[hit] = ends[candidate[hit]] >= start_keys[hit]
+        mask[valid] = hit
+        return(mask)
+
+    # Keys in the layout of `_interval_keys`
+    def keys(self):
+        return(self.chromosomes, self.ranks, self.starts, self.ends)
+
+    def to_frame(self):
+        return(self.intervals)
+
+    def __len__(self):
+        return(self.intervals.height)
+
+# Combined index of several panels for `annotate_panels`
+# Starts and ends of all panels cut the axis into segments that lie either
+# fully inside or fully outside of every single panel. For each panel the
+# number of its segments before each boundary is kept, so whether a variant
+# spanning segments lo..hi overlaps a panel is one difference of two counts
+def _combined_panel_keys(
+        panels,
+        col_name2 = 'chrom',
+        start_name2 = 'start',
+        end_name2 = 'end'
+):
+    indices = {
+        name: panel if isinstance(panel, PanelIndex)
+        else PanelIndex.from_frame(
+            panel,
+            col_name = col_name2,
+            start_name = start_name2,
+            end_name = end_name2
+        )
+        for name, panel in panels.items()
+    }
+    chromosomes = pl.concat(
+        [index.chromosomes for index in indices.values()]
+    ).unique().sort()
+    ranks = pl.Series(range(len(chromosomes)), dtype = pl.Int64)
+
+    intervals = {}
+    for name, index in indices.items():
+        rank = index.intervals['chrom'].replace_strict(
+            chromosomes,
+            ranks,
+            return_dtype = pl.Int64
+        ).to_numpy()
+        intervals[name] = (
+            rank * _CHROM_OFFSET + index.intervals['start'].to_numpy(),
+            rank * _CHROM_OFFSET + index.intervals['end'].to_numpy()
+        )
+    boundaries = np.unique(
+        np.concatenate(
+            [np.empty(0, dtype = np.int64)] +
+            [keys for starts, ends in intervals.values() for keys in (starts, ends + 1)]
+        )
+    )
+
+    counts = {}
+    for name, (starts, ends) in intervals.items():
+        # A segment belongs to the panel when its first position does
+        candidate = np.searchsorted(starts, boundaries, side = 'right') - 1
+        inside = candidate >= 0
+        inside[inside] = ends[candidate[inside]] >= boundaries[inside]
+        counts[name] = np.concatenate([[0], np.cumsum(inside)])
+
+    return(chromosomes, ranks, boundaries, counts)
+
+def annotate_panels(
+        df1,
+        panels,
+        subsets = False,
+        prefix = 'in_',
+        col_name1 = 'Chromosome',
+        start_name1 = 'Start_Position',
+        end_name1 = 'End_Position',
+        col_name2 = 'chrom',
+        start_name2 = 'start',
+        end_name2 = 'end'
+):
+    """
+    Overlap df1 (e.g. maf) with several panels in a single pass.
+
+    `panels` maps names to panels as taken by `cool_overlaps`, i.e. data
+    frames of intervals or `PanelIndex`. All panels are combined into one
+    index, so every variant is looked up twice no matter how many panels
+    there are. Returns df1 with a boolean `{prefix}{name}` column per
+    panel or, with `subsets = True`, a dict of the rows of df1 overlapping
+    each panel, every overlapping row once. Lazy df1 stays lazy unless
+    subsets are requested.
+    """
+
+    chromosomes, ranks, boundaries, counts = _combined_panel_keys(
+        panels,
+        col_name2 = col_name2,
+        start_name2 = start_name2,
+        end_name2 = end_name2
+    )
+    columns = df1.collect_schema().names()
+
+    offset = pl.col(col_name1).cast(pl.String).replace_strict(
+        chromosomes,
+        ranks,
+        default = None,
+        return_dtype = pl.Int64
+    ) * _CHROM_OFFSET
+    boundaries = pl.lit(pl.Series(boundaries, dtype = pl.Int64))
+    # Segments from the one holding the start to the one holding the end
+    first = boundaries.search_sorted(
+        offset + pl.col(start_name1).cast(pl.Int64),
+        side = 'right'
+    ).cast(pl.Int64) - 1
+    last = boundaries.search_sorted(
+        offset + pl.col(end_name1).cast(pl.Int64),
+        side = 'right'
+    ).cast(pl.Int64)
+
+    annotated = df1.with_columns(
+        _first = first.clip(lower_bound = 0),
+        _last = last
+    ).with_columns(
+        [
+            pl.when(
+                offset.is_not_null() &
+                pl.col(start_name1).is_not_null() &
+                pl.col(end_name1).is_not_null()
+            ).then(
+                pl.lit(pl.Series(count, dtype = pl.Int64)).gather(pl.col('_last')) -
+                pl.lit(pl.Series(count, dtype = pl.Int64)).gather(pl.col('_first')) > 0
+            ).otherwise(False).alias(f'{prefix}{name}')
+            for name, count in counts.items()
+        ]
+    ).drop(
+        ['_first', '_last']
+    )
+
+    if not subsets:
+        return(annotated)
+
+    if isinstance(annotated, pl.LazyFrame):
+        annotated = annotated.collect()
+    return(
+        {
+            name: annotated.filter(pl.col(f'{prefix}{name}')).select(columns)
+            for name in counts
+        }
+    )
+
 sbs_colors_list = [["SBS1", "#acf2d0"],
             ["SBS5", "#63d69e"],
             ["SBS2", "#f8b6b3"],
@@ -213,4 +572,90 @@ maf_header = [
     "HGVSc", "HGVSp", "HGVSp_Short", "Transcript_ID",
     "Exon_Number", "t_depth", "t_ref_count", "t_alt_count",
     "n_depth", "n_ref_count", "n_alt_count"
-]
\ No newline at end of file
+]
+# Columns SigProfiler actually reads when fitting SBS signatures from maf
+sbs_maf_columns = [
+    "Hugo_Symbol", "Chromosome", "Start_Position", "End_Position",
+    "Variant_Type", "Reference_Allele", "Tumor_Seq_Allele2",
+    "Tumor_Sample_Barcode"
+]
+
+# SigProfiler parses maf files by column position rather than by name,
+# so anything written for it must keep the first 16 standard columns
+sigprofiler_maf_layout = maf_header[:16]
+
+import re
+# Make sample id safe to use as a file name
+# SigProfiler takes everything before the first dot of a vcf file name
+# as the sample id, so dots are replaced as well
+def sanitize_sample_name(name):
+    name = re.sub(r'[^A-Za-z0-9_-]+', '_', str(name)).strip('_')
+    return(name if name else 'sample')
+
+# Read panel of regions from BED file as `chrom`, `start`, `end`
+# Extra columns are dropped; header and track lines are skipped
+def read_panel(file_path):
+    panel = pl.read_csv(
+        source = file_path,
+        has_header = False,
+        separator = '\t',
+        comment_prefix = '#',
+        infer_schema_length = 0
+    )
+    panel = panel.select(
+        panel.columns[:3]
+    ).rename(
+        dict(zip(panel.columns[:3], ['chrom', 'start', 'end']))
+    ).filter(
+        pl.col('start').str.contains(r'^\d+$')
+    ).with_columns(
+        pl.col('start').cast(pl.Int64),
+        pl.col('end').cast(pl.Int64)
+    )
+    return(panel)
+
+import os
+import shutil
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+# Process pool for parallel stages
+# Workers are spawned: forking a process that already runs polars threads
+# can deadlock
+def _spawn_pool(
+        max_workers,
+        initializer = None,
+        initargs = ()
+):
+    return(
+        ProcessPoolExecutor(
+            max_workers = max_workers,
+            mp_context = multiprocessing.get_context('spawn'),
+            initializer = initializer,
+            initargs = initargs
+        )
+    )
+
+# Place a file into a staging directory without copying its data
+# Falls back to a copy across file systems or where hard links are not supported
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy(source, target)
+
+# Yield a temporary path to write `out_file` to
+# The temporary sits next to the target and replaces it only once the
+# block finishes, so readers never see a partial file and a crash never
+# leaves a broken one
+@contextmanager
+def _atomic_write(out_file):
+    temporary = f'{out_file}.tmp'
+    try:
+        yield temporary
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    os.replace(temporary, out_file)
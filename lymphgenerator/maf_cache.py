@@ -0,0 +1,120 @@
+import polars as pl
+from pathlib import Path
+import hashlib
+import os
+from .helpers import _atomic_write, maf_header
+
+# Compact dtypes for the standard maf columns
+# Repetitive labels are categorical, positions and read counts fit int32;
+# everything else stays a string
+_categorical_columns = [
+    "Chromosome", "Tumor_Sample_Barcode", "Matched_Norm_Sample_Barcode",
+    "Variant_Classification", "Variant_Type", "Center", "NCBI_Build",
+    "Strand"
+]
+_int32_columns = [
+    "Start_Position", "End_Position", "Entrez_Gene_Id",
+    "t_depth", "t_ref_count", "t_alt_count",
+    "n_depth", "n_ref_count", "n_alt_count"
+]
+maf_schema = {
+    col: pl.Categorical if col in _categorical_columns
+    else pl.Int32 if col in _int32_columns
+    else pl.String
+    for col in maf_header
+}
+
+# Convert a tab-separated maf file to Arrow IPC with `maf_schema` dtypes
+# Columns outside of the maf standard are kept as strings; values that
+# are not numbers in integer columns become null. Columns without any
+# value are stored as null columns, which take no space on disk
+def convert_maf(
+        file_path,
+        out_file
+):
+    maf_data = pl.scan_csv(
+        source = file_path,
+        has_header = True,
+        separator = '\t',
+        comment_prefix = '#',
+        infer_schema = False
+    )
+    columns = maf_data.collect_schema().names()
+    filled = maf_data.select(
+        pl.all().is_not_null().any()
+    ).collect(
+        engine = 'streaming'
+    ).row(0, named = True)
+    maf_data = maf_data.with_columns(
+        [
+            pl.col(col).cast(pl.Null) if not filled[col]
+            else pl.col(col).cast(maf_schema[col], strict = False)
+            for col in columns
+            if not filled[col] or maf_schema.get(col, pl.String) != pl.String
+        ]
+    )
+    with _atomic_write(out_file) as temporary:
+        maf_data.sink_ipc(temporary, compression = 'uncompressed')
+    return(str(out_file))
+
+class MafCache:
+    """
+    Typed, memory-mappable copies of maf files.
+
+    Every maf file is converted to Arrow IPC with `maf_schema` dtypes the
+    first time it is loaded. Entries are keyed on the path of the source
+    file together with its size and modification time, so an edited file
+    is converted again and its stale copy is removed. Later loads memory
+    map the copy instead of parsing text.
+    """
+
+    def __init__(
+            self,
+            cache_dir
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+
+    def _source_key(self, file_path):
+        return(hashlib.sha256(str(Path(file_path).resolve()).encode()).hexdigest()[:16])
+
+    def path(self, file_path):
+        stat = os.stat(file_path)
+        version = hashlib.sha256(
+            f'{stat.st_size}|{stat.st_mtime_ns}'.encode()
+        ).hexdigest()[:16]
+        return(self.cache_dir / f'{self._source_key(file_path)}_{version}.arrow')
+
+    # Path of the up-to-date copy of a maf file, converting it if needed
+    def get(self, file_path):
+        path = self.path(file_path)
+        if not path.exists():
+            for stale in self.cache_dir.glob(f'{self._source_key(file_path)}_*.arrow'):
+                stale.unlink(missing_ok = True)
+            convert_maf(file_path, path)
+        return(path)
+
+    def load(
+            self,
+            file_path,
+            lazy = False
+    ):
+        path = self.get(file_path)
+        if lazy:
+            maf_data = pl.scan_ipc(path, memory_map = True)
+        else:
+            maf_data = pl.read_ipc(path, memory_map = True)
+        # Empty columns get their usual dtype back
+        return(
+            maf_data.with_columns(
+                [
+                    pl.col(col).cast(maf_schema.get(col, pl.String))
+                    for col, dtype in maf_data.collect_schema().items()
+                    if dtype == pl.Null
+                ]
+            )
+        )
+
+    def invalidate(self):
+        for path in self.cache_dir.glob('*.arrow'):
+            path.unlink(missing_ok = True)
@@ -0,0 +1,201 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# `resource` is Unix only; without it memory is not reported (None)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Resident memory of this process in bytes
+# Read from /proc where available, otherwise the peak so far is used
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return(int(statm.read().split()[1]) * _page_size)
+    except (OSError, IndexError, ValueError):
+        return(_max_rss('self'))
+
+# Peak resident memory in bytes of this process ('self') or of its
+# finished worker processes ('children')
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+def _max_rss(who):
+    if resource is None:
+        return(None)
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN
+    )
+    return(usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024)
+
+def _highest(*values):
+    values = [value for value in values if value is not None]
+    return(max(values) if values else None)
+
+# CPU time of this process and of its finished worker processes
+def _cpu_time():
+    times = os.times()
+    return(times.user + times.system + times.children_user + times.children_system)
+
+# Sample resident memory in the background to find the peak within a stage
+class _MemorySampler(threading.Thread):
+    def __init__(
+            self,
+            interval = 0.01
+    ):
+        super().__init__(daemon = True)
+        self.interval = interval
+        self.peak = _current_rss()
+        self._stopped = threading.Event()
+
+    def run(self):
+        # Nothing to sample where memory cannot be read
+        if self.peak is None:
+            return
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, _current_rss())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak = _highest(self.peak, _current_rss())
+        return(self.peak)
+
+# Default sink, prints progress of stages but not of single samples
+def print_sink(event):
+    if event.get('sample') is not None:
+        return
+    if event['event'] == 'start':
+        print(event.get('message') or f"Running {event['stage']} ...")
+    elif event['event'] == 'message':
+        print(event['message'])
+    elif event['event'] == 'end' and 'wall_time' in event:
+        memory = ''
+        if event.get('peak_memory') is not None:
+            memory = f", peak memory {event['peak_memory'] / 1e6:.0f} MB"
+        print(f"Finished {event['stage']} in {event['wall_time']:.1f} s{memory}")
+
+# Sink appending every event to a file as one JSON object per line
+def json_lines_sink(file_path):
+    lock = threading.Lock()
+    def _write(event):
+        with lock, open(file_path, 'a') as out:
+            out.write(json.dumps(event, default = str) + '\n')
+    return(_write)
+
+class PipelineMetrics:
+    """
+    Wall time, CPU time, peak memory, rows and bytes of pipeline stages.
+
+    Every stage start and end, per-sample record and message is passed to
+    each sink, i.e. any callable taking one event dict; `print_sink` is
+    the default. Peak memory of a stage is the highest resident memory
+    of this process while it ran; `peak_memory_workers` is the peak of
+    worker processes that finished so far. `report()` returns all records
+    as a JSON-ready dict.
+    """
+
+    def __init__(
+            self,
+            sinks = None
+    ):
+        self.sinks = [print_sink] if sinks is None else list(sinks)
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def _emit(self, event):
+        for sink in self.sinks:
+            sink(event)
+
+    def message(self, text):
+        self._emit({'event': 'message', 'message': text})
+
+    # Measure the enclosed block as one stage
+    # The yielded dict takes `rows`, `bytes` and any other counts
+    @contextmanager
+    def stage(
+            self,
+            name,
+            sample = None,
+            message = None,
+            **counts
+    ):
+        record = {'stage': name, 'sample': sample, **counts}
+        self._emit({'event': 'start', 'stage': name, 'sample': sample, 'message': message})
+        sampler = _MemorySampler()
+        start_memory = sampler.peak
+        sampler.start()
+        start_time = time.time()
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_time()
+        try:
+            yield record
+        finally:
+            record.update({
+                'start_time': start_time,
+                'start_memory': start_memory,
+                'wall_time': time.perf_counter() - start_wall,
+                'cpu_time': _cpu_time() - start_cpu,
+                'peak_memory': sampler.stop(),
+                'peak_memory_workers': _max_rss('children')
+            })
+            self._add(record)
+
+    # Measure one sample of a stage, e.g. in a worker thread
+    # CPU time is that of the calling thread. Samples share the process,
+    # so their peak memory is the higher of its resident memory at the
+    # start and at the end of the sample, while its data is still held
+    @contextmanager
+    def sample(
+            self,
+            name,
+            sample,
+            **counts
+    ):
+        record = {'stage': name, 'sample': sample, **counts}
+        start_memory = _current_rss()
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield record
+        finally:
+            record.update({
+                'wall_time': time.perf_counter() - start_wall,
+                'cpu_time': time.thread_time() - start_cpu,
+                'peak_memory': _highest(start_memory, _current_rss())
+            })
+            self._add(record)
+
+    # Add a measurement taken elsewhere, e.g. for a single sample
+    def record(
+            self,
+            name,
+            sample = None,
+            **values
+    ):
+        self._add({'stage': name, 'sample': sample, **values})
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(record)
+        self._emit({'event': 'end', **record})
+
+    def report(self):
+        return(
+            {
+                'stages': [record for record in self.records if record['sample'] is None],
+                'samples': [record for record in self.records if record['sample'] is not None]
+            }
+        )
+
+    def write_json(self, file_path):
+        with open(file_path, 'w') as out:
+            json.dump(self.report(), out, indent = 2, default = str)
+        return(file_path)
@@ -0,0 +1,242 @@
+import polars as pl
+import numpy as np
+from pathlib import Path
+from .helpers import _spawn_pool
+
+# Read COSMIC signature matrix (`Type` followed by one column per signature)
+# Without a path, the copy shipped with SigProfilerAssignment is used
+def load_cosmic_signatures(
+        file_path = None,
+        genome_build = "GRCh37",
+        cosmic_version = 3.4
+):
+    if file_path is None:
+        import importlib.util
+        spec = importlib.util.find_spec('SigProfilerAssignment')
+        if spec is None:
+            raise FileNotFoundError(
+                'No COSMIC signature file given and SigProfilerAssignment is not installed'
+            )
+        file_path = (
+            Path(spec.origin).parent /
+            'data' /
+            'Reference_Signatures' /
+            genome_build /
+            f'COSMIC_v{cosmic_version}_SBS_{genome_build}.txt'
+        )
+
+    signatures = pl.read_csv(
+        source = file_path,
+        has_header = True,
+        separator = '\t'
+    )
+
+    return(signatures.rename({signatures.columns[0]: 'MutationType'}))
+
+# Non-negative least squares of every sample, one after the other
+# Solves min ||W h - v|| with h >= 0 for every column v of V with the
+# active-set method of Lawson and Hanson, which ends at the exact optimum.
+# scipy raises a RuntimeError when a sample does not converge in
+# `max_iter` iterations, so no fit is returned unfinished
+def _nnls_batch(
+        weights,
+        counts,
+        max_iter = 1000
+):
+    from scipy.optimize import nnls
+    exposures = np.zeros((weights.shape[1], counts.shape[1]))
+    for i in np.flatnonzero(counts.sum(axis = 0) > 0):
+        exposures[:, i] = nnls(weights, counts[:, i], maxiter = max_iter)[0]
+    return(exposures)
+
+# Signature weights and sample counts as arrays, rows in the same channel order
+def _align_signatures(
+        matrix,
+        signatures = None,
+        signature_subset = None,
+        exclude_signatures = None,
+        genome_build = "GRCh37"
+):
+    if signatures is None or isinstance(signatures, (str, Path)):
+        signatures = load_cosmic_signatures(
+            file_path = signatures,
+            genome_build = genome_build
+        )
+
+    names = [col for col in signatures.columns if col != 'MutationType']
+    if signature_subset is not None:
+        names = [name for name in names if name in signature_subset]
+    if exclude_signatures is not None:
+        names = [name for name in names if name not in exclude_signatures]
+
+    # Align channels by name, both tables are 96 rows
+    aligned = signatures.select(
+        ['MutationType'] + names
+    ).join(
+        matrix,
+        on = 'MutationType',
+        how = 'inner',
+        maintain_order = 'left'
+    )
+    if aligned.height != signatures.height:
+        raise ValueError('Mutation types of matrix and signatures do not match')
+
+    samples = [col for col in matrix.columns if col != 'MutationType']
+    weights = aligned.select(names).to_numpy().astype(np.float64)
+    counts = aligned.select(samples).to_numpy().astype(np.float64)
+
+    return(names, samples, weights, counts)
+
+def fit_nnls_exposure(
+        matrix,
+        signatures = None,
+        signature_subset = None,
+        exclude_signatures = None,
+        genome_build = "GRCh37",
+        max_iter = 1000
+):
+    """
+    Fit COSMIC signature exposures to an SBS96 matrix with exact NNLS.
+
+    The matrix follows the SigProfiler layout (`MutationType` and one
+    column per sample, as returned by `build_sbs96_matrix`). Every sample
+    is fitted on its own, in well under a millisecond, and the result
+    has the layout of SigProfiler activities: `Samples` followed by
+    integer mutation counts per signature.
+    """
+
+    names, samples, weights, counts = _align_signatures(
+        matrix,
+        signatures = signatures,
+        signature_subset = signature_subset,
+        exclude_signatures = exclude_signatures,
+        genome_build = genome_build
+    )
+
+    exposures = _nnls_batch(weights, counts, max_iter = max_iter)
+
+    activities = pl.DataFrame(
+        _mutation_counts(exposures).T,
+        schema = names,
+        orient = 'row'
+    ).insert_column(
+        0,
+        pl.Series('Samples', samples, dtype = pl.String)
+    )
+
+    return(activities)
+
+# Fitted exposures as whole mutations, like SigProfiler activities
+def _mutation_counts(exposures):
+    return(np.rint(exposures).astype(np.int64))
+
+# Signature weights shared by all bootstrap jobs of a worker process
+def _init_bootstrap_worker(weights):
+    global _bootstrap_weights
+    _bootstrap_weights = weights
+
+# Share of every signature in the exposures of each column
+def _relative_exposure(exposures):
+    sums = exposures.sum(axis = 0, keepdims = True)
+    return(np.divide(exposures, sums, out = np.zeros_like(exposures, dtype = np.float64), where = sums > 0))
+
+# Resample the mutations of a few samples and refit every replicate
+# Drawing n mutations with replacement from a sample's 96 channels is a
+# multinomial draw with its observed channel frequencies, so all
+# replicates of a sample come from one vectorized draw. Every sample has
+# its own random stream. Returns bounds, samples x signatures x bounds
+def _bootstrap_job(job):
+    counts, n_bootstrap, bounds, seeds = job
+    weights = _bootstrap_weights
+    intervals = np.zeros((counts.shape[1], weights.shape[1], len(bounds)))
+    for i, seed in enumerate(seeds):
+        total = int(counts[:, i].sum())
+        if total == 0:
+            continue
+        resampled = np.random.default_rng(seed).multinomial(
+            total,
+            counts[:, i] / total,
+            size = n_bootstrap
+        ).T
+        intervals[i] = np.quantile(
+            _relative_exposure(_nnls_batch(weights, resampled.astype(np.float64))),
+            bounds,
+            axis = 1
+        ).T
+    return(intervals)
+
+def bootstrap_sbs_exposure(
+        matrix,
+        n_bootstrap = 200,
+        confidence = 0.95,
+        signatures = None,
+        signature_subset = None,
+        exclude_signatures = None,
+        genome_build = "GRCh37",
+        batch_size = 20000,
+        n_jobs = 4,
+        seed = None
+):
+    """
+    Bootstrap confidence intervals of relative signature exposure.
+
+    Every sample of the SBS96 matrix (see `build_sbs96_matrix`) is
+    resampled `n_bootstrap` times, drawing as many mutations as it has
+    with replacement, and every replicate is refitted with NNLS. Samples
+    are sent to `n_jobs` processes in batches of about `batch_size`
+    replicates. Returns one row per sample and signature with the point
+    estimate of relative exposure (`exposure`, `fit_nnls_exposure` scaled
+    as by `scale_sbs_exposure`) and the `lower` and `upper` percentile bounds at `confidence`.
+    Results are reproducible for a given `seed`, whatever the number of
+    jobs or batch size.
+    """
+
+    names, samples, weights, counts = _align_signatures(
+        matrix,
+        signatures = signatures,
+        signature_subset = signature_subset,
+        exclude_signatures = exclude_signatures,
+        genome_build = genome_build
+    )
+    # Same fit and rounding as `fit_nnls_exposure`
+    relative = _relative_exposure(_mutation_counts(_nnls_batch(weights, counts)))
+
+    alpha = (1 - confidence) / 2
+    seeds = np.random.SeedSequence(seed).spawn(len(samples))
+    # Smaller batches when there are too few samples to keep every job busy
+    per_job = max(1, min(batch_size // n_bootstrap, -(-len(samples) // n_jobs)))
+    jobs = [
+        (
+            counts[:, start:start + per_job],
+            n_bootstrap,
+            [alpha, 1 - alpha],
+            seeds[start:start + per_job]
+        )
+        for start in range(0, len(samples), per_job)
+    ]
+    with _spawn_pool(
+        n_jobs,
+        initializer = _init_bootstrap_worker,
+        initargs = (weights, )
+    ) as pool:
+        intervals = list(pool.map(_bootstrap_job, jobs))
+    intervals = np.concatenate(intervals, axis = 0) if intervals else np.zeros((0, len(names), 2))
+
+    return(
+        pl.DataFrame(
+            {
+                'Samples': np.repeat(np.array(samples, dtype = object), len(names)),
+                'signature': np.tile(np.array(names, dtype = object), len(samples)),
+                'exposure': relative.T.reshape(-1),
+                'lower': intervals[:, :, 0].reshape(-1),
+                'upper': intervals[:, :, 1].reshape(-1)
+            },
+            schema = {
+                'Samples': pl.String,
+                'signature': pl.String,
+                'exposure': pl.Float64,
+                'lower': pl.Float64,
+                'upper': pl.Float64
+            }
+        )
+    )
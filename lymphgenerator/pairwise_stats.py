@@ -0,0 +1,179 @@
+import polars as pl
+import numpy as np
+from scipy import stats, special
+
+# Pairs of group positions, from the outside pairs of boxes inwards
+# This is the order significance bars are stacked in the plots
+def group_pairs(n_groups):
+    ls = list(range(n_groups))
+    return(
+        [(ls[x], ls[x + y]) for y in reversed(range(1, n_groups)) for x in range(n_groups - y)]
+    )
+
+# Two-sided Mann-Whitney U test of two groups sorted beforehand
+# Ranks come from binary search of one group in the other, so pooled
+# data is never re-sorted. Matches scipy.stats.mannwhitneyu defaults
+def _mannwhitneyu_sorted(
+        x,
+        y,
+        x_counts,
+        y_counts
+):
+    n1, n2 = len(x), len(y)
+    if n1 == 0 or n2 == 0:
+        return(None, None)
+
+    less = np.searchsorted(y, x, side = 'left')
+    equal = np.searchsorted(y, x, side = 'right') - less
+    U1 = float(np.sum(less + 0.5 * equal))
+    U2 = n1 * n2 - U1
+
+    # Tie sizes of the pooled sample
+    values = np.concatenate([x_counts[0], y_counts[0]])
+    counts = np.concatenate([x_counts[1], y_counts[1]])
+    _, inverse = np.unique(values, return_inverse = True)
+    t = np.bincount(inverse, weights = counts)
+    has_ties = np.any(t > 1)
+
+    # Same choice of method as scipy with method = 'auto'
+    if min(n1, n2) <= 8 and not has_ties:
+        p = stats.mannwhitneyu(x, y, alternative = 'two-sided', method = 'exact').pvalue
+        return(U1, float(p))
+
+    n = n1 + n2
+    U = max(U1, U2)
+    tie_term = np.sum(t ** 3 - t)
+    s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        z = (U - n1 * n2 / 2 - 0.5) / s
+    p = min(max(2 * special.ndtr(-z), 0.), 1.)
+
+    return(U1, float(p))
+
+# Adjust p-values for multiple testing within one family of tests
+def adjust_pvalues(
+        pvalues,
+        method = 'fdr_bh'
+):
+    p = np.asarray(pvalues, dtype = np.float64)
+    adjusted = np.full(len(p), np.nan)
+    valid = ~np.isnan(p)
+    m = int(valid.sum())
+    if m == 0:
+        return(adjusted)
+    pv = p[valid]
+    order = np.argsort(pv)
+    ranked = pv[order]
+
+    if method == 'bonferroni':
+        result = np.minimum(pv * m, 1)
+    elif method == 'holm':
+        steps = np.maximum.accumulate((m - np.arange(m)) * ranked)
+        result = np.empty(m)
+        result[order] = np.minimum(steps, 1)
+    elif method == 'fdr_bh':
+        steps = np.minimum.accumulate((m / np.arange(m, 0, -1)) * ranked[::-1])[::-1]
+        result = np.empty(m)
+        result[order] = np.minimum(steps, 1)
+    else:
+        raise ValueError(f'Unknown p-value correction: {method}')
+
+    adjusted[valid] = result
+    return(adjusted)
+
+def pairwise_mannwhitney(
+        incoming_data,
+        comparison_column,
+        response_column,
+        groups = None,
+        by = None,
+        correction = None
+):
+    """
+    All pairwise two-sided Mann-Whitney U tests between groups.
+
+    Data is partitioned by group (and by the `by` columns, e.g. facets)
+    once, and each group is sorted once; pairs are then tested without
+    filtering the data again. Pairs follow `group_pairs` order. With
+    `correction` ('bonferroni', 'holm' or 'fdr_bh'), p-values are also
+    adjusted within each `by` partition.
+    """
+
+    by = [] if by is None else ([by] if isinstance(by, str) else list(by))
+    data = incoming_data.select(
+        by + [comparison_column, response_column]
+    ).drop_nulls(
+        response_column
+    )
+    if groups is None:
+        groups = data[comparison_column].unique(maintain_order = True).to_list()
+    groups = list(groups)
+    pairs = group_pairs(len(groups))
+
+    partitions = data.partition_by(by, as_dict = True) if by else {(): data}
+
+    rows = []
+    for key, partition in partitions.items():
+        # One sorted array and value counts per group
+        values = {
+            group: np.sort(np.asarray(response, dtype = np.float64))
+            for group, response in partition.group_by(comparison_column)
+            .agg(pl.col(response_column)).iter_rows()
+        }
+        empty = np.array([], dtype = np.float64)
+        counts = {
+            group: np.unique(sorted_values, return_counts = True)
+            for group, sorted_values in values.items()
+        }
+        empty_counts = (empty, np.array([], dtype = np.int64))
+
+        family = []
+        for first, second in pairs:
+            x = values.get(groups[first], empty)
+            y = values.get(groups[second], empty)
+            U, p = _mannwhitneyu_sorted(
+                x,
+                y,
+                counts.get(groups[first], empty_counts),
+                counts.get(groups[second], empty_counts)
+            )
+            family.append(
+                list(key) +
+                [groups[first], groups[second], first, second, len(x), len(y), U, p]
+            )
+
+        if correction is not None:
+            adjusted = adjust_pvalues(
+                [np.nan if row[-1] is None else row[-1] for row in family],
+                method = correction
+            )
+            family = [
+                row + [None if np.isnan(value) else float(value)]
+                for row, value in zip(family, adjusted)
+            ]
+        rows.extend(family)
+
+    schema = {col: incoming_data.schema[col] for col in by}
+    schema.update({
+        'group_1': pl.String,
+        'group_2': pl.String,
+        'index_1': pl.Int64,
+        'index_2': pl.Int64,
+        'n_1': pl.Int64,
+        'n_2': pl.Int64,
+        'U': pl.Float64,
+        'p.value': pl.Float64
+    })
+    if correction is not None:
+        schema['p.adj'] = pl.Float64
+
+    return(
+        pl.DataFrame(
+            [
+                row[:len(by)] + [str(row[len(by)]), str(row[len(by) + 1])] + row[len(by) + 2:]
+                for row in rows
+            ],
+            schema = schema,
+            orient = 'row'
+        )
+    )
@@ -0,0 +1,503 @@
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import polars as pl
+from .helpers import (
+    PanelIndex,
+    _atomic_write,
+    _link_or_copy,
+    sanitize_sample_name
+)
+from .estimate_sbs_exposure import (
+    _COSMIC_VERSION,
+    _restore_sample_names,
+    load_maf,
+    maf_paths,
+    merge_activities,
+    run_sigprofiler,
+    scale_sbs_exposure,
+    select_represented_sbs,
+    stage_sbs,
+    write_sample_mafs
+)
+from .metrics import PipelineMetrics
+from .sbs_matrix import build_sbs96_matrix
+
+# Stages of the pipeline, in the order they run
+pipeline_stages = ['ingest', 'split', 'fit', 'scale', 'filter']
+
+class PipelineManifest:
+    """
+    Checkpoints of a pipeline run, kept as manifest.json in the work directory.
+
+    Every stage is recorded with a fingerprint of its settings and of the
+    stages before it. A stage is skipped on rerun when it finished under
+    the same fingerprint; the fit stage also records finished samples, so
+    an interrupted fit only refits the samples that are left.
+    """
+
+    def __init__(
+            self,
+            work_dir
+    ):
+        self.path = pathlib.Path(work_dir) / 'manifest.json'
+        self.stages = {}
+        if self.path.exists():
+            self.stages = json.loads(self.path.read_text())['stages']
+
+    def _write(self):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        with _atomic_write(self.path) as temporary:
+            pathlib.Path(temporary).write_text(json.dumps({'stages': self.stages}, indent = 2))
+
+    def done(
+            self,
+            stage,
+            fingerprint
+    ):
+        entry = self.stages.get(stage)
+        return(
+            entry is not None and
+            entry['status'] == 'done' and
+            entry['fingerprint'] == fingerprint
+        )
+
+    # Start a stage, keeping finished samples if the settings are unchanged
+    def start(
+            self,
+            stage,
+            fingerprint
+    ):
+        entry = self.stages.get(stage)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            entry = {'fingerprint': fingerprint, 'samples': []}
+        entry['status'] = 'running'
+        self.stages[stage] = entry
+        self._write()
+
+    def add_samples(
+            self,
+            stage,
+            samples
+    ):
+        self.stages[stage]['samples'] += list(samples)
+        self._write()
+
+    def finish(
+            self,
+            stage,
+            **outputs
+    ):
+        self.stages[stage].update(outputs)
+        self.stages[stage]['status'] = 'done'
+        self._write()
+
+    def get(
+            self,
+            stage,
+            field,
+            default = None
+    ):
+        return(self.stages.get(stage, {}).get(field, default))
+
+# Fingerprint of stage settings, chained to the previous stage
+def _fingerprint(
+        previous,
+        **settings
+):
+    text = json.dumps(settings, sort_keys = True, default = str) + (previous or '')
+    return(hashlib.sha256(text.encode()).hexdigest())
+
+# Identify input files by path, size and modification time
+def _file_signature(file_path):
+    if file_path is None:
+        return(None)
+    stat = os.stat(file_path)
+    return([os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns])
+
+# A glob pattern or list of maf files changes with any of its files
+def _maf_signature(maf_file):
+    if isinstance(maf_file, (str, os.PathLike)) and os.path.exists(maf_file):
+        return(_file_signature(maf_file))
+    return([_file_signature(path) for path in maf_paths(maf_file)])
+
+def _ingest(
+        work_dir,
+        maf_file,
+        panel_file = None,
+        samples = None
+):
+    panel = None
+    if panel_file is not None:
+        # A saved PanelIndex or a BED file
+        if str(panel_file).endswith('.arrow'):
+            panel = PanelIndex.load(panel_file)
+        else:
+            panel = PanelIndex.from_bed(panel_file)
+    maf_data = load_maf(
+        subset_to_panel = panel is not None,
+        panel = panel,
+        lazy = True,
+        samples = samples,
+        file_path = maf_file
+    )
+    out_file = work_dir / 'ingest' / 'variants.parquet'
+    out_file.parent.mkdir(parents = True, exist_ok = True)
+    maf_data.write_parquet(out_file)
+    return({'output': str(out_file), 'rows': maf_data.height})
+
+# Per-sample maf files, or one SBS96 matrix when a reference fasta is given
+# `staging` writes minimal maf or vcf files instead, see `stage_sbs`
+def _split(
+        work_dir,
+        variants,
+        reference_fasta = None,
+        staging = None,
+        n_jobs = 1,
+        metrics = None
+):
+    split_path = work_dir / 'split'
+    shutil.rmtree(split_path, ignore_errors = True)
+    split_path.mkdir(parents = True)
+    maf_data = pl.read_parquet(variants)
+
+    if reference_fasta is not None:
+        matrix = build_sbs96_matrix(maf_data, reference_fasta, metrics = metrics)
+        out_file = split_path / 'sbs96_matrix.parquet'
+        matrix.write_parquet(out_file)
+        return({'output': str(out_file), 'input_type': 'matrix', 'sample_files': {}})
+
+    if staging is not None:
+        maf_data = stage_sbs(maf_data, staging = staging)
+    paths = write_sample_mafs(
+        maf_data,
+        out_path = str(split_path / 'mafs'),
+        n_jobs = n_jobs,
+        metrics = metrics
+    )
+    samples = maf_data['Tumor_Sample_Barcode'].unique(maintain_order = True).to_list()
+    return(
+        {
+            'output': str(split_path / 'mafs'),
+            'input_type': 'maf',
+            'sample_files': dict(zip(samples, paths))
+        }
+    )
+
+# Activities file of a sample; ids that sanitize to the same name
+# still get their own file
+def _activities_name(sample):
+    digest = hashlib.sha256(str(sample).encode()).hexdigest()[:8]
+    return(f'{sanitize_sample_name(sample)}_{digest}.parquet')
+
+# Fit pending samples in batches; every finished batch is checkpointed
+def _fit(
+        work_dir,
+        manifest,
+        split,
+        genome_build = "GRCh37",
+        backend = "sigprofiler",
+        signature_subset = None,
+        export_probabilities_per_mutation = True,
+        batch_size = 200,
+        n_jobs = 1,
+        metrics = None
+):
+    fit_path = work_dir / 'fit'
+    activities_path = fit_path / 'activities'
+    probabilities = fit_path / 'Decomposed_Mutation_Probabilities'
+    finished = set(manifest.get('fit', 'samples', []))
+    # A new fit, or one with changed settings, starts from empty outputs
+    if not finished:
+        shutil.rmtree(activities_path, ignore_errors = True)
+        shutil.rmtree(probabilities, ignore_errors = True)
+    activities_path.mkdir(parents = True, exist_ok = True)
+
+    matrix = None
+    if split['input_type'] == 'matrix':
+        matrix = pl.read_parquet(split['output'])
+        samples = matrix.columns[1:]
+    else:
+        samples = list(split['sample_files'])
+    pending = [sample for sample in samples if sample not in finished]
+    metrics.message(f'Fitting {len(pending)} samples, {len(finished)} already done ...')
+
+    for first in range(0, len(pending), batch_size):
+        batch = pending[first:first + batch_size]
+        batch_path = fit_path / 'batch'
+        shutil.rmtree(batch_path, ignore_errors = True)
+
+        if matrix is not None:
+            incoming_data = matrix.select(['MutationType'] + batch)
+        else:
+            incoming_data = batch_path / 'input'
+            incoming_data.mkdir(parents = True)
+            for sample in batch:
+                source = pathlib.Path(split['sample_files'][sample])
+                _link_or_copy(source, incoming_data / source.name)
+            incoming_data = str(incoming_data)
+
+        activities_file = run_sigprofiler(
+            incoming_data = incoming_data,
+            out_path = str(batch_path / 'output'),
+            genome_build = genome_build,
+            export_probabilities_per_mutation = export_probabilities_per_mutation,
+            n_shards = n_jobs,
+            n_jobs = n_jobs,
+            backend = backend,
+            signature_subset = signature_subset,
+            metrics = metrics
+        )
+
+        _restore_sample_names(
+            activities_file,
+            {path: sample for sample, path in split['sample_files'].items()}
+        )
+        for activities in merge_activities([activities_file]).partition_by('Samples'):
+            activities.write_parquet(
+                activities_path / _activities_name(activities['Samples'][0])
+            )
+        # Per-mutation probabilities are one file per sample already
+        for file in (batch_path / 'output').glob('**/Decomposed_Mutation_Probabilities_*.txt'):
+            probabilities.mkdir(exist_ok = True)
+            shutil.move(str(file), str(probabilities / file.name))
+
+        shutil.rmtree(batch_path, ignore_errors = True)
+        # Samples without any fitted SBS are done as well
+        manifest.add_samples('fit', batch)
+
+    return({'output': str(activities_path)})
+
+# Only samples of the current fit are scaled; samples without any
+# fitted SBS have no activities file
+def _scale(
+        work_dir,
+        activities_path,
+        samples,
+        metrics = None
+):
+    files = [
+        file for file in (
+            pathlib.Path(activities_path) / _activities_name(sample)
+            for sample in samples
+        )
+        if file.exists()
+    ]
+    if not files:
+        raise RuntimeError(
+            f'No fitted activities to scale in {activities_path}; '
+            'no sample had single-base substitutions to fit'
+        )
+    out_path = work_dir / 'scale'
+    out_path.mkdir(parents = True, exist_ok = True)
+    activities = merge_activities(
+        [pl.read_parquet(file) for file in files],
+        out_file = str(out_path / 'Assignment_Solution_Activities.txt')
+    )
+    out_file = out_path / 'exposures.parquet'
+    scaled = scale_sbs_exposure(activities, out_file = str(out_file), metrics = metrics)
+    return({'output': str(out_file), 'rows': scaled.height})
+
+def _filter(
+        work_dir,
+        exposures,
+        threshold = 0.1
+):
+    selected = select_represented_sbs(pl.read_parquet(exposures), threshold = threshold)
+    out_file = work_dir / 'filter' / 'represented_sbs.parquet'
+    out_file.parent.mkdir(parents = True, exist_ok = True)
+    selected.write_parquet(out_file)
+    return({'output': str(out_file), 'signatures': selected.columns[1:]})
+
+def run_pipeline(
+        work_dir,
+        maf_file,
+        panel_file = None,
+        samples = None,
+        stages = pipeline_stages,
+        genome_build = "GRCh37",
+        reference_fasta = None,
+        staging = None,
+        backend = "sigprofiler",
+        signature_subset = None,
+        export_probabilities_per_mutation = True,
+        threshold = 0.1,
+        batch_size = 200,
+        n_jobs = 1,
+        force = False,
+        metrics = None
+):
+    """
+    Resumable SBS exposure estimation in stages: ingest, split, fit, scale
+    and filter.
+
+    Outputs and checkpoints live in `work_dir`. Stages that already
+    finished with the same inputs and settings are skipped, and an
+    interrupted fit continues with the samples that are left. A stage
+    needs the stages before it to have finished, in this or an earlier
+    run. `staging = 'maf'` or 'vcf' splits single-base substitutions
+    into minimal per-sample files, see `stage_sbs`. `n_jobs` sets the
+    parallelism of every stage. Timing and memory of the stages run go
+    to `metrics` and to metrics.json in `work_dir`.
+    Returns the manifest entries of all stages.
+    """
+
+    # Fail before any stage runs rather than in the fit stage
+    if backend == "nnls" and reference_fasta is None:
+        raise ValueError('NNLS backend needs reference_fasta to build the SBS96 matrix')
+
+    metrics = metrics if metrics is not None else PipelineMetrics()
+
+    work_dir = pathlib.Path(work_dir)
+    work_dir.mkdir(parents = True, exist_ok = True)
+    manifest = PipelineManifest(work_dir)
+
+    fingerprints = {}
+    previous = None
+    for stage, settings in [
+        ('ingest', {
+            'maf': _maf_signature(maf_file),
+            'panel': _file_signature(panel_file),
+            'samples': sorted(samples) if samples is not None else None
+        }),
+        ('split', {
+            'reference_fasta': _file_signature(reference_fasta),
+            'staging': staging
+        }),
+        ('fit', {
+            'genome_build': genome_build,
+            'cosmic_version': _COSMIC_VERSION,
+            'backend': backend,
+            'signature_subset': sorted(signature_subset) if signature_subset else None,
+            'probabilities': export_probabilities_per_mutation
+        }),
+        ('scale', {}),
+        ('filter', {'threshold': threshold})
+    ]:
+        previous = fingerprints[stage] = _fingerprint(previous, **settings)
+
+    for i, stage in enumerate(pipeline_stages):
+        if stage not in stages:
+            continue
+        fingerprint = fingerprints[stage]
+        if manifest.done(stage, fingerprint) and not force:
+            metrics.message(f'Skipping {stage}, already done')
+            continue
+        for required in pipeline_stages[:i]:
+            if not manifest.done(required, fingerprints[required]):
+                raise RuntimeError(
+                    f'Stage {stage} needs stage {required} to be completed first'
+                )
+
+        # Forced stages start over, and so does everything after them
+        if force:
+            for later in pipeline_stages[i:]:
+                manifest.stages.pop(later, None)
+            force = False
+        manifest.start(stage, fingerprint)
+        with metrics.stage(stage, scope = 'pipeline') as record:
+            if stage == 'ingest':
+                outputs = _ingest(work_dir, maf_file, panel_file = panel_file, samples = samples)
+            elif stage == 'split':
+                outputs = _split(
+                    work_dir,
+                    manifest.get('ingest', 'output'),
+                    reference_fasta = reference_fasta,
+                    staging = staging,
+                    n_jobs = n_jobs,
+                    metrics = metrics
+                )
+            elif stage == 'fit':
+                outputs = _fit(
+                    work_dir,
+                    manifest,
+                    manifest.stages['split'],
+                    genome_build = genome_build,
+                    backend = backend,
+                    signature_subset = signature_subset,
+                    export_probabilities_per_mutation = export_probabilities_per_mutation,
+                    batch_size = batch_size,
+                    n_jobs = n_jobs,
+                    metrics = metrics
+                )
+            elif stage == 'scale':
+                outputs = _scale(
+                    work_dir,
+                    manifest.get('fit', 'output'),
+                    manifest.get('fit', 'samples', []),
+                    metrics = metrics
+                )
+            else:
+                outputs = _filter(
+                    work_dir,
+                    manifest.get('scale', 'output'),
+                    threshold = threshold
+                )
+            record.update(rows = outputs.get('rows'))
+        manifest.finish(stage, **outputs)
+
+    metrics.write_json(work_dir / 'metrics.json')
+    return(manifest.stages)
+
+# Console entry point, see `lymphgenerator --help`
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = 'lymphgenerator',
+        description = 'Resumable SBS exposure estimation from a maf file'
+    )
+    parser.add_argument('--work-dir', required = True, help = 'Directory for outputs and checkpoints')
+    parser.add_argument('--maf', required = True, help = 'Multi-sample maf file or glob pattern of maf files')
+    parser.add_argument('--panel', default = None, help = 'BED file or saved PanelIndex of regions to keep')
+    parser.add_argument('--samples', default = None, help = 'Comma-separated sample ids to keep')
+    parser.add_argument(
+        '--stages',
+        default = ','.join(pipeline_stages),
+        help = f'Comma-separated stages to run, out of {",".join(pipeline_stages)}'
+    )
+    parser.add_argument('--genome-build', default = 'GRCh37')
+    parser.add_argument('--reference-fasta', default = None, help = 'Build the SBS96 matrix from this fasta')
+    parser.add_argument(
+        '--staging',
+        default = None,
+        choices = ['maf', 'vcf'],
+        help = 'Stage only single-base substitutions for SigProfiler, as minimal maf or vcf files'
+    )
+    parser.add_argument('--backend', default = 'sigprofiler', choices = ['sigprofiler', 'nnls'])
+    parser.add_argument('--signature-subset', default = None, help = 'Comma-separated signatures to fit')
+    parser.add_argument('--no-probabilities', action = 'store_true', help = 'Do not export per-mutation probabilities')
+    parser.add_argument('--threshold', type = float, default = 0.1, help = 'Fraction of samples for a signature to be kept')
+    parser.add_argument('--batch-size', type = int, default = 200, help = 'Samples fitted between checkpoints')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Parallel jobs per stage')
+    parser.add_argument('--force', action = 'store_true', help = 'Rerun the selected stages')
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(',')
+    unknown = [stage for stage in stages if stage not in pipeline_stages]
+    if unknown:
+        parser.error(f'Unknown stages: {",".join(unknown)}')
+    if args.backend == 'nnls' and args.reference_fasta is None:
+        parser.error('--backend nnls needs --reference-fasta')
+
+    run_pipeline(
+        work_dir = args.work_dir,
+        maf_file = args.maf,
+        panel_file = args.panel,
+        samples = args.samples.split(',') if args.samples else None,
+        stages = stages,
+        genome_build = args.genome_build,
+        reference_fasta = args.reference_fasta,
+        staging = args.staging,
+        backend = args.backend,
+        signature_subset = args.signature_subset.split(',') if args.signature_subset else None,
+        export_probabilities_per_mutation = not args.no_probabilities,
+        threshold = args.threshold,
+        batch_size = args.batch_size,
+        n_jobs = args.jobs,
+        force = args.force
+    )
+
+if __name__ == '__main__':
+    main()
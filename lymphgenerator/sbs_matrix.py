@@ -0,0 +1,210 @@
+import polars as pl
+import numpy as np
+from pathlib import Path
+from .metrics import PipelineMetrics
+
+# SBS96 channels in the order used by COSMIC signature files
+# i.e. sorted by 5' base, substitution and 3' base
+sbs96_substitutions = ['C>A', 'C>G', 'C>T', 'T>A', 'T>C', 'T>G']
+sbs96_channels = [
+    f'{five}[{substitution}]{three}'
+    for five in 'ACGT'
+    for substitution in sbs96_substitutions
+    for three in 'ACGT'
+]
+
+# Lookup tables over ASCII codes
+_base_index = np.full(256, -1, dtype = np.int64)
+for i, base in enumerate('ACGT'):
+    _base_index[ord(base)] = i
+    _base_index[ord(base.lower())] = i
+_complement = np.arange(256, dtype = np.uint8)
+for base, pair in zip('ACGTacgt', 'TGCATGCA'):
+    _complement[ord(base)] = ord(pair)
+_upper = np.arange(256, dtype = np.uint8)
+_upper[ord('a'):ord('z') + 1] -= 32
+
+# Index of the substitution among sbs96_substitutions
+# by pyrimidine reference (C, T) and alternative base
+_substitution_index = np.full((4, 4), -1, dtype = np.int64)
+for i, substitution in enumerate(sbs96_substitutions):
+    ref, alt = substitution.split('>')
+    _substitution_index['ACGT'.index(ref), 'ACGT'.index(alt)] = i
+
+class ReferenceFasta:
+    """
+    Memory-mapped reference genome for random access to bases.
+
+    Uses the samtools .fai index next to the fasta file and creates it when
+    missing. Only the pages holding requested positions are ever read.
+    """
+
+    def __init__(
+            self,
+            fasta_path
+    ):
+        self.fasta_path = str(fasta_path)
+        self.index = self._read_index()
+        self.sequence = np.memmap(self.fasta_path, dtype = np.uint8, mode = 'r')
+
+    def _read_index(self):
+        fai_path = Path(f'{self.fasta_path}.fai')
+        if not fai_path.exists():
+            self._write_index(fai_path)
+        index = {}
+        with open(fai_path) as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = line.split('\t')[:5]
+                index[name] = (
+                    int(length),
+                    int(offset),
+                    int(line_bases),
+                    int(line_width)
+                )
+        return(index)
+
+    # Same format as `samtools faidx`
+    def _write_index(self, fai_path):
+        records = []
+        with open(self.fasta_path, 'rb') as fasta:
+            offset = 0
+            record = None
+            for line in fasta:
+                if line.startswith(b'>'):
+                    if record is not None:
+                        records.append(record)
+                    name = line[1:].split()[0].decode()
+                    record = [name, 0, offset + len(line), 0, 0]
+                elif record is not None:
+                    if record[3] == 0:
+                        record[3] = len(line.rstrip(b'\r\n'))
+                        record[4] = len(line)
+                    record[1] += len(line.rstrip(b'\r\n'))
+                offset += len(line)
+            if record is not None:
+                records.append(record)
+        with open(fai_path, 'w') as fai:
+            for record in records:
+                fai.write('\t'.join(str(field) for field in record) + '\n')
+
+    # Accept both `1` and `chr1` styles of chromosome names
+    def _resolve(self, chromosome):
+        chromosome = str(chromosome)
+        for name in [chromosome, f'chr{chromosome}', chromosome.removeprefix('chr')]:
+            if name in self.index:
+                return(name)
+        if chromosome in ['MT', 'chrM', 'M'] and 'chrM' in self.index:
+            return('chrM')
+        return(None)
+
+    # Upper case bases at 1-based positions of one chromosome
+    # Positions outside of the chromosome are returned as `N`
+    def fetch(
+            self,
+            chromosome,
+            positions
+    ):
+        positions = np.asarray(positions, dtype = np.int64)
+        name = self._resolve(chromosome)
+        bases = np.full(len(positions), ord('N'), dtype = np.uint8)
+        if name is None:
+            return(bases)
+        length, offset, line_bases, line_width = self.index[name]
+        valid = (positions >= 1) & (positions <= length)
+        zero_based = positions[valid] - 1
+        byte_offsets = offset + (zero_based // line_bases) * line_width + zero_based % line_bases
+        bases[valid] = _upper[self.sequence[byte_offsets]]
+        return(bases)
+
+# Count SBS96 channels per sample straight from maf data
+# Returns the SigProfiler matrix layout: `MutationType` followed by
+# one column of counts per sample, channels in COSMIC order
+def build_sbs96_matrix(
+        maf_data,
+        reference,
+        sample_column = 'Tumor_Sample_Barcode',
+        metrics = None
+):
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    if not isinstance(reference, ReferenceFasta):
+        reference = ReferenceFasta(reference)
+
+    snvs = maf_data.filter(
+        (pl.col('Reference_Allele').str.len_chars() == 1) &
+        (pl.col('Tumor_Seq_Allele2').str.len_chars() == 1) &
+        pl.col('Reference_Allele').is_in(list('ACGT')) &
+        pl.col('Tumor_Seq_Allele2').is_in(list('ACGT')) &
+        (pl.col('Reference_Allele') != pl.col('Tumor_Seq_Allele2'))
+    ).select(
+        [sample_column, 'Chromosome', 'Start_Position',
+         'Reference_Allele', 'Tumor_Seq_Allele2']
+    )
+
+    samples = snvs[sample_column].unique().sort()
+    sample_ids = snvs[sample_column].replace_strict(
+        samples,
+        pl.Series(range(len(samples))),
+        return_dtype = pl.Int64
+    ).to_numpy()
+
+    n = snvs.height
+    five = np.empty(n, dtype = np.uint8)
+    middle = np.empty(n, dtype = np.uint8)
+    three = np.empty(n, dtype = np.uint8)
+    rows = snvs.with_row_index('_row')
+    for (chromosome, ), chromosome_snvs in rows.group_by('Chromosome'):
+        index = chromosome_snvs['_row'].to_numpy()
+        positions = chromosome_snvs['Start_Position'].to_numpy()
+        five[index] = reference.fetch(chromosome, positions - 1)
+        middle[index] = reference.fetch(chromosome, positions)
+        three[index] = reference.fetch(chromosome, positions + 1)
+
+    ref = np.frombuffer(
+        ''.join(snvs['Reference_Allele'].to_list()).encode(),
+        dtype = np.uint8
+    )
+    alt = np.frombuffer(
+        ''.join(snvs['Tumor_Seq_Allele2'].to_list()).encode(),
+        dtype = np.uint8
+    )
+
+    # Report on the pyrimidine strand: purine references are
+    # complemented and the context is read in reverse
+    purine = (ref == ord('A')) | (ref == ord('G'))
+    ref = np.where(purine, _complement[ref], ref)
+    alt = np.where(purine, _complement[alt], alt)
+    five, three = (
+        np.where(purine, _complement[three], five),
+        np.where(purine, _complement[five], three)
+    )
+    middle = np.where(purine, _complement[middle], middle)
+
+    substitution = _substitution_index[_base_index[ref], _base_index[alt]]
+    channel = _base_index[five] * 24 + substitution * 4 + _base_index[three]
+
+    # Skip variants with unknown context or a reference that
+    # does not match the genome
+    keep = (
+        (_base_index[five] >= 0) &
+        (_base_index[three] >= 0) &
+        (middle == ref)
+    )
+    skipped = int((~keep).sum())
+    if skipped:
+        metrics.message(f'Skipped {skipped} variants not matching the reference genome')
+
+    counts = np.bincount(
+        sample_ids[keep] * 96 + channel[keep],
+        minlength = len(samples) * 96
+    ).reshape(len(samples), 96)
+
+    matrix = pl.DataFrame(
+        counts.T,
+        schema = samples.to_list(),
+        orient = 'row'
+    ).insert_column(
+        0,
+        pl.Series('MutationType', sbs96_channels)
+    )
+
+    return(matrix)
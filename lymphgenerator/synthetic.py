@@ -0,0 +1,204 @@
+import polars as pl
+import numpy as np
+from .helpers import maf_header
+
+# Chromosome lengths of GRCh37
+grch37_lengths = {
+    '1': 249250621, '2': 243199373, '3': 198022430, '4': 191154276,
+    '5': 180915260, '6': 171115067, '7': 159138663, '8': 146364022,
+    '9': 141213431, '10': 135534747, '11': 135006516, '12': 133851895,
+    '13': 115169878, '14': 107349540, '15': 102531392, '16': 90354753,
+    '17': 81195210, '18': 78077248, '19': 59128983, '20': 63025520,
+    '21': 48129895, '22': 51304566, 'X': 155270560, 'Y': 59373566
+}
+
+_snv_classifications = [
+    'Missense_Mutation', 'Silent', 'Nonsense_Mutation', 'Intron',
+    "3'UTR", "5'UTR", 'Splice_Site', 'IGR'
+]
+_snv_weights = [0.35, 0.15, 0.03, 0.25, 0.08, 0.04, 0.02, 0.08]
+_indel_classifications = {
+    'DEL': ['Frame_Shift_Del', 'In_Frame_Del', 'Intron'],
+    'INS': ['Frame_Shift_Ins', 'In_Frame_Ins', 'Intron']
+}
+
+# Random regions, as `chrom`, `start`, `end` like a BED panel
+def synthetic_panel(
+        n_regions = 1000,
+        region_size = (100, 2000),
+        chromosomes = None,
+        seed = None
+):
+    rng = np.random.default_rng(seed)
+    lengths = grch37_lengths if chromosomes is None else {
+        chromosome: grch37_lengths[chromosome] for chromosome in chromosomes
+    }
+    names = list(lengths)
+    sizes = np.array([lengths[name] for name in names], dtype = np.int64)
+    chrom = rng.choice(len(names), size = n_regions, p = sizes / sizes.sum())
+    width = rng.integers(region_size[0], region_size[1] + 1, size = n_regions)
+    start = (rng.random(n_regions) * (sizes[chrom] - width)).astype(np.int64) + 1
+
+    return(
+        pl.DataFrame({
+            'chrom': np.array(names)[chrom],
+            'start': start,
+            'end': start + width - 1
+        }).sort(
+            [pl.col('chrom').replace_strict(names, range(len(names))), 'start']
+        )
+    )
+
+def synthetic_maf(
+        n_samples = 10,
+        variants_per_sample = 1000,
+        snv_fraction = 0.9,
+        chromosomes = None,
+        panel = None,
+        sample_prefix = 'SYN',
+        seed = None
+):
+    """
+    Random multi-sample maf data with all `maf_header` columns.
+
+    `variants_per_sample` is one number for every sample or one per
+    sample. Variants are SNVs with probability `snv_fraction`, otherwise
+    deletions or insertions of 1-5 bases. Positions are uniform over the
+    chosen chromosomes of GRCh37 or, when a `panel` (`chrom`, `start`,
+    `end`) is given, over its regions. Rows are sorted by sample and
+    position, and columns without a meaningful value are left empty.
+    """
+
+    rng = np.random.default_rng(seed)
+    counts = np.broadcast_to(np.asarray(variants_per_sample, dtype = np.int64), (n_samples, ))
+    n = int(counts.sum())
+    width = len(str(max(n_samples - 1, 0)))
+    samples = [f'{sample_prefix}_{i:0{width}d}' for i in range(n_samples)]
+
+    # Positions, weighted by chromosome or region length
+    if panel is not None:
+        region_chrom = panel['chrom'].cast(pl.String)
+        region_start = panel['start'].to_numpy().astype(np.int64)
+        region_size = panel['end'].to_numpy().astype(np.int64) - region_start + 1
+        region = rng.choice(len(region_size), size = n, p = region_size / region_size.sum())
+        names = list(grch37_lengths) + sorted(set(region_chrom) - set(grch37_lengths))
+        chrom = region_chrom.replace_strict(names, range(len(names))).to_numpy()[region]
+        position = region_start[region] + (rng.random(n) * region_size[region]).astype(np.int64)
+    else:
+        lengths = grch37_lengths if chromosomes is None else {
+            name: grch37_lengths[name] for name in chromosomes
+        }
+        names = list(lengths)
+        sizes = np.array([lengths[name] for name in names], dtype = np.int64)
+        chrom = rng.choice(len(names), size = n, p = sizes / sizes.sum())
+        position = (rng.random(n) * sizes[chrom]).astype(np.int64) + 1
+
+    # Sort by sample and position; all other fields are drawn independently
+    sample = np.repeat(np.arange(n_samples), counts)
+    order = np.lexsort((position, chrom, sample))
+    chrom = chrom[order]
+    position = position[order]
+
+    variant_type = pl.Series(['SNP', 'DEL', 'INS']).gather(
+        np.where(
+            rng.random(n) < snv_fraction,
+            0,
+            np.where(rng.random(n) < 0.6, 1, 2)
+        )
+    )
+
+    # Alleles: SNVs change to one of the three other bases,
+    # indels take 1-5 bases from a pool of random sequences
+    bases = pl.Series(list('ACGT'))
+    ref_base = rng.integers(0, 4, size = n)
+    alt_base = (ref_base + rng.integers(1, 4, size = n)) % 4
+    pool = pl.Series([''.join(seq) for seq in rng.choice(list('ACGT'), size = (1024, 5))])
+    indel_length = rng.integers(1, 6, size = n)
+    sequence = pool.gather(rng.integers(0, 1024, size = n)).str.slice(0, pl.Series(indel_length))
+
+    snv_class = pl.Series(_snv_classifications).gather(
+        rng.choice(len(_snv_classifications), size = n, p = _snv_weights)
+    )
+    indel_class = rng.integers(0, 3, size = n)
+
+    maf_data = pl.DataFrame({
+        'Tumor_Sample_Barcode': pl.Series(samples).gather(sample),
+        'Chromosome': pl.Series(names).gather(chrom),
+        'Start_Position': position,
+        'Variant_Type': variant_type,
+        '_ref': bases.gather(ref_base),
+        '_alt': bases.gather(alt_base),
+        '_sequence': sequence,
+        '_length': indel_length,
+        '_snv_class': snv_class,
+        '_del_class': pl.Series(_indel_classifications['DEL']).gather(indel_class),
+        '_ins_class': pl.Series(_indel_classifications['INS']).gather(indel_class),
+        't_depth': rng.integers(20, 400, size = n)
+    }).with_columns(
+        Reference_Allele = pl.when(pl.col('Variant_Type') == 'SNP').then(pl.col('_ref'))
+            .when(pl.col('Variant_Type') == 'DEL').then(pl.col('_sequence'))
+            .otherwise(pl.lit('-')),
+        Tumor_Seq_Allele2 = pl.when(pl.col('Variant_Type') == 'SNP').then(pl.col('_alt'))
+            .when(pl.col('Variant_Type') == 'INS').then(pl.col('_sequence'))
+            .otherwise(pl.lit('-')),
+        End_Position = pl.when(pl.col('Variant_Type') == 'DEL')
+            .then(pl.col('Start_Position') + pl.col('_length') - 1)
+            .when(pl.col('Variant_Type') == 'INS')
+            .then(pl.col('Start_Position') + 1)
+            .otherwise(pl.col('Start_Position')),
+        Variant_Classification = pl.when(pl.col('Variant_Type') == 'SNP').then(pl.col('_snv_class'))
+            .when(pl.col('Variant_Type') == 'DEL').then(pl.col('_del_class'))
+            .otherwise(pl.col('_ins_class')),
+        t_alt_count = (pl.col('t_depth') * pl.Series(rng.beta(2, 5, size = n))).cast(pl.Int64).clip(1)
+    ).with_columns(
+        Tumor_Seq_Allele1 = pl.col('Reference_Allele'),
+        t_ref_count = pl.col('t_depth') - pl.col('t_alt_count'),
+        n_depth = pl.col('t_depth'),
+        n_ref_count = pl.col('t_depth'),
+        n_alt_count = pl.lit(0, dtype = pl.Int64),
+        Hugo_Symbol = pl.format('GENE{}', (pl.col('Start_Position') // 100000) % 20000),
+        Entrez_Gene_Id = pl.lit(0, dtype = pl.Int64),
+        Center = pl.lit('synthetic'),
+        NCBI_Build = pl.lit('GRCh37'),
+        Strand = pl.lit('+'),
+        Matched_Norm_Sample_Barcode = pl.col('Tumor_Sample_Barcode') + '_normal'
+    )
+
+    return(
+        maf_data.select(
+            [
+                pl.col(col) if col in maf_data.columns
+                else pl.lit(None, dtype = pl.String).alias(col)
+                for col in maf_header
+            ]
+        )
+    )
+
+# Random SigProfiler activities: `Samples` and mutation counts per signature
+# Every sample has a handful of active signatures
+def synthetic_activities(
+        n_samples = 100,
+        n_signatures = 20,
+        active_signatures = 4,
+        mutations_per_sample = 1000,
+        seed = None
+):
+    rng = np.random.default_rng(seed)
+    signatures = [f'SBS{i + 1}' for i in range(n_signatures)]
+    weights = rng.dirichlet(np.full(n_signatures, 0.5), size = n_samples)
+    # Keep only the strongest signatures of every sample
+    cutoff = -np.sort(-weights, axis = 1)[:, min(active_signatures, n_signatures) - 1:][:, :1]
+    weights = np.where(weights >= cutoff, weights, 0)
+    weights /= weights.sum(axis = 1, keepdims = True)
+    counts = np.rint(weights * mutations_per_sample).astype(np.int64)
+
+    return(
+        pl.DataFrame(
+            counts,
+            schema = signatures,
+            orient = 'row'
+        ).insert_column(
+            0,
+            pl.Series('Samples', [f'SYN_{i}' for i in range(n_samples)])
+        )
+    )
@@ -1,7 +1,67 @@
 import polars as pl
-from scipy import stats
 import matplotlib.pyplot as plt
 import seaborn as sns
+from .pairwise_stats import pairwise_mannwhitney
+
+# Significance label for p-value
+def _significance_symbol(p):
+    if p < 0.001:
+        return('***')
+    elif p < 0.01:
+        return('**')
+    return('*')
+
+# Draw bars over the significant pairs of boxes
+# Pairs come in `group_pairs` order, from the outside pairs inwards
+def _significance_bars(
+        significant,
+        top,
+        y_range,
+        fontsize = 10
+):
+    for i, (x1, x2, p) in enumerate(significant):
+        # What level is this bar among the bars above the plot?
+        level = len(significant) - i
+        # Plot the bar
+        bar_height = (y_range * 0.07 * level) + top
+        bar_tips = bar_height - (y_range * 0.02)
+        plt.plot(
+            [x1, x1, x2, x2],
+            [bar_tips, bar_height, bar_height, bar_tips], lw=1, c='k'
+        )
+        # Significance level
+        text_height = bar_height + (y_range * 0.01)
+        plt.text(
+            (x1 + x2) * 0.5,
+            text_height,
+            _significance_symbol(p),
+            ha='center',
+            va='bottom',
+            c='k',
+            fontsize=fontsize*0.9
+        )
+
+# Show the figure, or save it when a file is given
+def _finish_figure(
+        figure,
+        out_file = None,
+        show = True
+):
+    if out_file is not None:
+        figure.savefig(out_file, bbox_inches = 'tight')
+        plt.close(figure)
+    elif show:
+        plt.show()
+
+# Significant pairs of the stats table as (x1, x2, p)
+def _significant_pairs(stats_table):
+    return(
+        stats_table.filter(
+            pl.col('p.value') < 0.05
+        ).select(
+            ['index_1', 'index_2', 'p.value']
+        ).rows()
+    )
 
 def plot_and_whisker(
         incoming_data,
@@ -19,80 +79,43 @@ def plot_and_whisker(
         rotate_x_labels = False,
         fontsize = 10,
         col_spacing = 0.5,
-        padding = 15
+        padding = 15,
+        return_stats = False,
+        out_file = None,
+        show = True
     ):
     """
     Create a violin-and-whisker plot with significance bars.
+
+    Pairwise tests come from `pairwise_mannwhitney`; with
+    `return_stats = True` its table of all pairs is returned. When
+    faceting, the tests of all facets are run in one grouped pass and the
+    table is keyed by the `facet_on` column, group_1 and group_2.
+    With `out_file` the figure is saved there instead of shown.
     """
 
     sns.set_theme(style = "ticks")
+    plot_title = None
+    stats_table = None
+    facet_significant = {}
 
     def _annotate(**kwargs):
         data = pl.DataFrame(kwargs.pop('data'))
-        # Assume the order of groups is the same as labels on x axis
-        df_list = xticklabels
-        # Stat test for difference
-        # Default uses mannwhitneyu
-        # Initialise a list of combinations of groups
-        significant_combinations = []
-        # Check from the outside pairs of boxes inwards
-        ls = list(range(1, len(df_list) + 1))
-        combinations = [
-            (ls[x], ls[x + y]) for y in reversed(ls) for x in range((len(ls) - y))
-        ]
-        max_value = float('-inf')
-        for combination in combinations:
-            data1 = data.filter(
-                pl.col(comparison_column) == df_list[combination[0] - 1]
-            ).to_series()
-            data2 = data.filter(
-                pl.col(comparison_column) == df_list[combination[1] - 1]
-            ).to_series()
-            combined_max = pl.concat([data1, data2]).max()
-            if combined_max > max_value:
-                max_value = combined_max
-            # Significance
-            U, p = stats.mannwhitneyu(data1, data2, alternative='two-sided')
-            if p < 0.05:
-                significant_combinations.append([combination, p])
+        # Tests of this facet were computed before drawing
+        significant = facet_significant.get(data[facet_on][0], [])
+        max_value = data.filter(
+            pl.col(comparison_column).is_in(xticklabels)
+        )[response_column].max()
         # Add significance labels
         # Get the y-axis limits
         bottom, top = 0, max_value*1.2
         y_range = top - bottom
-
-        # Significance bars
-        for i, significant_combination in enumerate(significant_combinations):
-            # Columns corresponding to the datasets of interest
-            x1 = significant_combination[0][0] - 1
-            x2 = significant_combination[0][1] - 1
-            # What level is this bar among the bars above the plot?
-            level = len(significant_combinations) - i
-            # Plot the bar
-            bar_height = (y_range * 0.07 * level) + top
-            bar_tips = bar_height - (y_range * 0.02)
-            plt.plot(
-                [x1, x1, x2, x2],
-                [bar_tips, bar_height, bar_height, bar_tips], lw=1, c='k'
-            )
-            # Significance level
-            p = significant_combination[1]
-            if p < 0.001:
-                sig_symbol = '***'
-            elif p < 0.01:
-                sig_symbol = '**'
-            elif p < 0.05:
-                sig_symbol = '*'
-            text_height = bar_height + (y_range * 0.01)
-            plt.text(
-                (x1 + x2) * 0.5,
-                text_height,
-                sig_symbol,
-                ha='center',
-                va='bottom',
-                c='k',
-                fontsize=fontsize*0.9
-            )
-
+        _significance_bars(
+            significant,
+            top,
+            y_range,
+            fontsize = fontsize
+        )
 
     # Subset data if needed
     if subsetting_column is not None:
@@ -130,6 +153,23 @@ def plot_and_whisker(
                 ).to_series()
             )
 
+        # Assume the order of groups is the same as labels on x axis
+        # Stat test for difference uses mannwhitneyu, all facets at once
+        stats_table = pairwise_mannwhitney(
+            data,
+            comparison_column,
+            response_column,
+            groups = xticklabels,
+            by = facet_on
+        )
+        facet_significant = {
+            key: _significant_pairs(facet_stats)
+            for (key, ), facet_stats in stats_table.partition_by(
+                facet_on,
+                as_dict = True
+            ).items()
+        }
+
         # Generate plot
         ax = sns.FacetGrid(
             data.to_pandas(),
@@ -169,31 +209,17 @@ def plot_and_whisker(
         for a in ax.axes.flat:
             a.set_title(a.get_title(), fontsize=fontsize, pad = padding)
         ax.figure.subplots_adjust(hspace=col_spacing, wspace=col_spacing)
-        plt.show()
+        _finish_figure(ax.figure, out_file = out_file, show = show)
 
     else:
         # Assume the order of groups is the same as labels on x axis
-        df_list = xticklabels
-        # Stat test for difference
-        # Default uses mannwhitneyu
-        # Initialise a list of combinations of groups
-        significant_combinations = []
-        # Check from the outside pairs of boxes inwards
-        ls = list(range(1, len(df_list) + 1))
-        combinations = [
-            (ls[x], ls[x + y]) for y in reversed(ls) for x in range((len(ls) - y))
-        ]
-        for combination in combinations:
-            data1 = data.filter(
-                pl.col(comparison_column) == df_list[combination[0] - 1]
-            ).to_series()
-            data2 = data.filter(
-                pl.col(comparison_column) == df_list[combination[1] - 1]
-            ).to_series()
-            # Significance
-            U, p = stats.mannwhitneyu(data1, data2, alternative='two-sided')
-            if p < 0.05:
-                significant_combinations.append([combination, p])
+        # Stat test for difference uses mannwhitneyu
+        stats_table = pairwise_mannwhitney(
+            data,
+            comparison_column,
+            response_column,
+            groups = xticklabels
+        )
 
         # Generate plot
         f, ax = plt.subplots(figsize = figsize)
@@ -228,69 +254,74 @@ def plot_and_whisker(
         bottom, top = ax.get_ylim()
         y_range = top - bottom
 
-        # Significance bars
-        for i, significant_combination in enumerate(significant_combinations):
-            # Columns corresponding to the datasets of interest
-            x1 = significant_combination[0][0] - 1
-            x2 = significant_combination[0][1] - 1
-            # What level is this bar among the bars above the plot?
-            level = len(significant_combinations) - i
-            # Plot the bar
-            bar_height = (y_range * 0.07 * level) + top
-            bar_tips = bar_height - (y_range * 0.02)
-            plt.plot(
-                [x1, x1, x2, x2],
-                [bar_tips, bar_height, bar_height, bar_tips], lw=1, c='k'
-            )
-            # Significance level
-            p = significant_combination[1]
-            if p < 0.001:
-                sig_symbol = '***'
-            elif p < 0.01:
-                sig_symbol = '**'
-            elif p < 0.05:
-                sig_symbol = '*'
-            text_height = bar_height + (y_range * 0.01)
-            plt.text(
-                (x1 + x2) * 0.5,
-                text_height,
-                sig_symbol,
-                ha='center',
-                va='bottom',
-                c='k',
-                fontsize=fontsize*0.9
-            )
-        
+        _significance_bars(
+            _significant_pairs(stats_table),
+            top,
+            y_range,
+            fontsize = fontsize
+        )
+
         if rotate_x_labels:
             ax.tick_params(axis='x', rotation=90)
-        plt.show()
+        _finish_figure(f, out_file = out_file, show = show)
 
-    if print_stats_table:
-        first = [item[0][0] - 1 for item in significant_combinations]
-        last = [item[0][1] - 1 for item in significant_combinations]
-        stats_table = pl.DataFrame(
-                significant_combinations,
-                schema = ['index', "p.value"]
+    if print_stats_table and stats_table is not None:
+        print(
+            stats_table.filter(
+                pl.col('p.value') < 0.05
             ).select(
-                'p.value'
-            ).insert_column(
-                0,
-                pl.DataFrame(
-                    [df_list[i] for i in first],
-                    schema = ["group_1"]
-                ).to_series()
-            ).insert_column(
-                1,
-                pl.DataFrame(
-                    [df_list[i] for i in last],
-                    schema = ["group_2"]
-                ).to_series()
+                ([facet_on] if facet else []) + ['group_1', 'group_2', 'p.value']
             ).with_columns(
                 signature = pl.lit(plot_title)
             )
-        print(stats_table)
+        )
+
+    if return_stats:
+        return(stats_table)
 
 
+# Draw stacked bars of relative exposures of one sample onto an axis
+def _draw_stacked(
+        small_maf,
+        sample_id,
+        ax,
+        custom_colours,
+        bbox_to_anchor = (-0.1, -0.5),
+        comparison_column = 'method',
+        response_column = 'exposure',
+        color_on = 'signature',
+        ylabel = 'Relative SBS exposure',
+        legend = True
+):
+    sns.histplot(
+        small_maf.filter(pl.col(response_column) > 0).to_pandas(),
+        x=comparison_column,
+        hue=color_on,
+        weights=response_column,
+        multiple='stack',
+        palette=custom_colours,
+        legend=legend,
+        ax=ax
+    )
+    if legend and ax.get_legend() is not None:
+        sns.move_legend(
+            ax,
+            "lower left",
+            bbox_to_anchor=bbox_to_anchor,
+            ncol=5,
+            title=None,
+            frameon=False
+        )
+    ax.set(ylabel = ylabel)
+    ax.set_title(
+            label = sample_id,
+            loc = 'left',
+            fontweight = 'bold'
+        )
+    if len(small_maf[comparison_column].unique()) > 4:
+        ax.tick_params(axis='x', rotation=90)
+    sns.despine(ax=ax, trim=True)
+
 def plot_stacked(
         data,
         sample_id,
@@ -300,7 +331,9 @@ def plot_stacked(
         comparison_column='method',
         response_column='exposure',
         color_on='signature',
-        ylabel='Relative SBS exposure'
+        ylabel='Relative SBS exposure',
+        out_file = None,
+        show = True
 ):
     small_maf = data.filter(
         pl.col(sample_column) == sample_id
@@ -308,29 +341,247 @@ def plot_stacked(
 
     # Generate plot
     sns.set_theme(style = "ticks")
-    ax = sns.histplot(
-        small_maf.filter(pl.col(response_column) > 0).to_pandas(),
-        x=comparison_column,
-        hue=color_on,
-        weights=response_column,
-        multiple='stack',
-        palette=custom_colours
-    )
-    sns.move_legend(
+    ax = plt.gca()
+    _draw_stacked(
+        small_maf,
+        sample_id,
         ax,
-        "lower left",
-        bbox_to_anchor=bbox_to_anchor,
-        ncol=5,
-        title=None,
-        frameon=False
+        custom_colours,
+        bbox_to_anchor = bbox_to_anchor,
+        comparison_column = comparison_column,
+        response_column = response_column,
+        color_on = color_on,
+        ylabel = ylabel
     )
-    ax.set(ylabel = ylabel)
-    plt.title(
-            label = sample_id,
-            loc = 'left',
-            fontweight = 'bold'
-        )
-    if len(small_maf[comparison_column].unique()) > 4:
-        ax.tick_params(axis='x', rotation=90)
-    sns.despine(trim=True)
-    plt.show()
+    _finish_figure(ax.figure, out_file = out_file, show = show)
+
+# Batch rendering of plot_and_whisker across a process pool
+# Each worker receives the data once and renders with the Agg backend
+import os
+import pickle
+from collections import deque
+from matplotlib.backends.backend_pdf import PdfPages
+from .helpers import _spawn_pool, sanitize_sample_name
+
+_batch_data = None
+
+def _init_batch_worker(data):
+    global _batch_data
+    _batch_data = data
+    plt.switch_backend('Agg')
+
+def _render_batch_job(job):
+    response_column, subsetting_value, out_file, plot_kwargs = job
+    plot_kwargs = dict(plot_kwargs)
+    plot_kwargs.setdefault('ylabel', response_column)
+    # Jobs without a value plot all rows, whatever the subsetting column
+    if subsetting_value is None:
+        plot_kwargs['subsetting_column'] = None
+    stats_table = plot_and_whisker(
+        _batch_data,
+        response_column = response_column,
+        subsetting_value = subsetting_value,
+        print_stats_table = False,
+        return_stats = True,
+        out_file = out_file,
+        show = False,
+        **plot_kwargs
+    )
+    # Figures for a multipage pdf are sent back to the main process
+    figure = None
+    if out_file is None:
+        figure = pickle.dumps(plt.gcf())
+        plt.close('all')
+    stats_table = stats_table.with_columns(
+        signature = pl.lit(response_column),
+        subset = pl.lit(subsetting_value, dtype = pl.String)
+    ) if stats_table is not None else None
+    return(stats_table, figure)
+
+def plot_and_whisker_batch(
+        incoming_data,
+        jobs,
+        out_path,
+        file_format = 'png',
+        multipage_pdf = None,
+        n_jobs = 4,
+        **plot_kwargs
+):
+    """
+    Render plot_and_whisker for many (response_column, subsetting_value) jobs.
+
+    Figures are drawn headless in `n_jobs` processes and written to
+    `out_path` as one file per job, or into a single multipage pdf when
+    `multipage_pdf` is a file name. Other arguments are passed on to
+    plot_and_whisker (e.g. comparison_column, xticklabels,
+    subsetting_column). Returns the stats tables of all jobs combined.
+    """
+
+    jobs = list(jobs)
+    if plot_kwargs.get('subsetting_column') is None and any(
+            subsetting_value is not None for _, subsetting_value in jobs):
+        raise ValueError('Jobs with a subsetting_value need subsetting_column')
+
+    os.makedirs(out_path, exist_ok = True)
+    tasks = []
+    for response_column, subsetting_value in jobs:
+        out_file = None
+        if multipage_pdf is None:
+            name = response_column if subsetting_value is None \
+                else f'{response_column}_{subsetting_value}'
+            out_file = os.path.join(
+                out_path,
+                f'{sanitize_sample_name(name)}.{file_format}'
+            )
+        tasks.append((response_column, subsetting_value, out_file, plot_kwargs))
+
+    tables = []
+    pdf = None
+    if multipage_pdf is not None:
+        pdf = PdfPages(os.path.join(out_path, multipage_pdf))
+
+    def _collect(future):
+        table, figure = future.result()
+        if table is not None:
+            tables.append(table)
+        if figure is not None:
+            figure = pickle.loads(figure)
+            pdf.savefig(figure, bbox_inches = 'tight')
+            plt.close(figure)
+
+    try:
+        with _spawn_pool(
+            n_jobs,
+            initializer = _init_batch_worker,
+            initargs = (incoming_data, )
+        ) as pool:
+            # Keep a bounded number of figures in flight, in job order
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.submit(_render_batch_job, task))
+                if len(pending) >= 2 * n_jobs:
+                    _collect(pending.popleft())
+            while pending:
+                _collect(pending.popleft())
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+    return(pl.concat(tables, how = 'diagonal_relaxed') if tables else pl.DataFrame())
+
+# One page of the stacked report: a grid of samples
+# Multi-panel pages share one legend below the grid
+def _render_stacked_page(job):
+    page, out_file, nrows, ncols, figsize, plot_kwargs = job
+    sns.set_theme(style = "ticks")
+    figure, axes = plt.subplots(nrows, ncols, figsize = figsize, squeeze = False)
+    for i, (ax, (sample_id, small_maf)) in enumerate(zip(axes.flat, page)):
+        _draw_stacked(small_maf, sample_id, ax, legend = i == 0, **plot_kwargs)
+    for ax in axes.flat[len(page):]:
+        ax.set_axis_off()
+    if nrows * ncols > 1:
+        legend = axes.flat[0].get_legend()
+        if legend is not None:
+            figure.legend(
+                legend.legend_handles,
+                [text.get_text() for text in legend.get_texts()],
+                loc = 'lower center',
+                ncol = 5,
+                frameon = False
+            )
+            legend.remove()
+        figure.tight_layout(rect = (0, 0.08, 1, 1))
+
+    if out_file is not None:
+        figure.savefig(out_file, bbox_inches = 'tight')
+        plt.close(figure)
+        return(None)
+    pickled = pickle.dumps(figure)
+    plt.close(figure)
+    return(pickled)
+
+def plot_stacked_report(
+        data,
+        out_path,
+        custom_colours,
+        samples = None,
+        sample_column = 'Tumor_Sample_Barcode',
+        multipage_pdf = None,
+        file_format = 'png',
+        nrows = 1,
+        ncols = 1,
+        figsize = (7, 6),
+        n_jobs = 4,
+        **plot_kwargs
+):
+    """
+    Stacked exposure bars for a whole cohort.
+
+    The long-format table is partitioned by `sample_column` once and pages
+    of `nrows` x `ncols` samples are drawn headless in `n_jobs` processes.
+    Pages go into a single multipage pdf when `multipage_pdf` is a file
+    name, otherwise one file per page is written to `out_path`. Only a few
+    pages are in flight at a time, so memory does not grow with the
+    number of samples. Other arguments are passed on to the plot (e.g.
+    comparison_column, response_column, color_on, ylabel).
+    Returns the paths of the written files.
+    """
+
+    os.makedirs(out_path, exist_ok = True)
+    partitions = data.partition_by(sample_column, as_dict = True)
+    if samples is None:
+        samples = [key for (key, ) in partitions.keys()]
+    # Samples without rows in the table are not drawn
+    samples = [sample_id for sample_id in samples if (sample_id, ) in partitions]
+    plot_kwargs['custom_colours'] = custom_colours
+    per_page = nrows * ncols
+
+    def _jobs():
+        for first in range(0, len(samples), per_page):
+            page = [
+                (sample_id, partitions[(sample_id, )])
+                for sample_id in samples[first:first + per_page]
+            ]
+            out_file = None
+            if multipage_pdf is None:
+                name = page[0][0] if per_page == 1 else f'page_{first // per_page + 1}'
+                out_file = os.path.join(
+                    out_path,
+                    f'{sanitize_sample_name(str(name))}.{file_format}'
+                )
+            yield (page, out_file, nrows, ncols, figsize, plot_kwargs)
+
+    written = []
+    pdf = None
+    if multipage_pdf is not None:
+        pdf = PdfPages(os.path.join(out_path, multipage_pdf))
+        written.append(os.path.join(out_path, multipage_pdf))
+
+    def _collect(future, out_file):
+        figure = future.result()
+        if figure is None:
+            written.append(out_file)
+        else:
+            figure = pickle.loads(figure)
+            pdf.savefig(figure, bbox_inches = 'tight')
+            plt.close(figure)
+
+    try:
+        with _spawn_pool(
+            n_jobs,
+            initializer = plt.switch_backend,
+            initargs = ('Agg', )
+        ) as pool:
+            # Keep a bounded number of pages in flight, in page order
+            pending = deque()
+            for job in _jobs():
+                pending.append((pool.submit(_render_stacked_page, job), job[1]))
+                if len(pending) >= 2 * n_jobs:
+                    _collect(*pending.popleft())
+            while pending:
+                _collect(*pending.popleft())
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+    return(written)
@@ -15,9 +15,12 @@ setuptools.setup(
     url = about["__url__"],
     author = about["__author__"],
     package_dir = {"lymphgenerator": pkg_path},
-    install_requires = ['polars', 'SigProfilerAssignment', 'seaborn'],
+    install_requires = ['polars', 'numpy', 'SigProfilerAssignment', 'seaborn'],
     author_email = about["__author_email__"],
     license = about["__license__"],
     packages = setuptools.find_packages(),
+    entry_points = {
+        "console_scripts": ["lymphgenerator = lymphgenerator.pipeline:main"]
+    },
     zip_safe = False
 )
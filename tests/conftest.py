@@ -0,0 +1,74 @@
+import importlib
+import pathlib
+import types
+import numpy as np
+import polars as pl
+import pytest
+
+_complement = dict(zip('ACGT', 'TGCA'))
+
+# Stand-in for SigProfilerAssignment's cosmic_fit on per-sample maf or
+# vcf files: every sample gets its mutation count split over two
+# signatures, and per-mutation probabilities when asked for
+def _cosmic_fit(
+        samples,
+        output,
+        input_type = 'vcf',
+        export_probabilities_per_mutation = False,
+        **kwargs
+):
+    # Input files may share a directory with the output
+    files = sorted(file for file in pathlib.Path(samples).iterdir() if file.is_file())
+    activities_path = pathlib.Path(output) / 'Assignment_Solution' / 'Activities'
+    activities_path.mkdir(parents = True, exist_ok = True)
+    rows = []
+    for file in files:
+        if file.suffix == '.vcf':
+            variants = pl.read_csv(file, separator = '\t', skip_rows = 1, infer_schema = False)
+            name = file.name.split('.')[0]
+            chromosome, position, ref, alt = '#CHROM', 'POS', 'REF', 'ALT'
+        else:
+            variants = pl.read_csv(file, separator = '\t', infer_schema = False)
+            name = variants['Tumor_Sample_Barcode'][0]
+            chromosome, position, ref, alt = (
+                'Chromosome', 'Start_Position', 'Reference_Allele', 'Tumor_Seq_Allele2'
+            )
+        rows.append((name, variants.height - variants.height // 3, variants.height // 3))
+        if not export_probabilities_per_mutation:
+            continue
+        variants = variants.filter(
+            pl.col(ref).str.contains('^[ACGT]$') & pl.col(alt).str.contains('^[ACGT]$')
+        )
+        mutation_types = [
+            f'A[{_complement[r] if r in "AG" else r}>{_complement[a] if r in "AG" else a}]A'
+            for r, a in zip(variants[ref], variants[alt])
+        ]
+        weights = np.random.default_rng(variants.height).random(variants.height)
+        probabilities_path = activities_path / 'Decomposed_Mutation_Probabilities'
+        probabilities_path.mkdir(exist_ok = True)
+        pl.DataFrame(
+            {
+                'Sample Names': [name] * variants.height,
+                'Chr': variants[chromosome].str.replace('^chr', ''),
+                'Pos': variants[position].cast(pl.Int64),
+                'MutationType': mutation_types,
+                'SBS1': weights,
+                'SBS5': 1 - weights
+            }
+        ).write_csv(
+            probabilities_path / f'Decomposed_Mutation_Probabilities_{name}.txt',
+            separator = '\t'
+        )
+    pl.DataFrame(
+        rows,
+        schema = ['Samples', 'SBS1', 'SBS5'],
+        orient = 'row'
+    ).write_csv(activities_path / 'Assignment_Solution_Activities.txt', separator = '\t')
+
+@pytest.fixture
+def fake_sigprofiler(monkeypatch):
+    # The package re-exports a function of the same name as the module
+    module = importlib.import_module('lymphgenerator.estimate_sbs_exposure')
+    analyzer = types.SimpleNamespace(cosmic_fit = _cosmic_fit)
+    monkeypatch.setattr(module, '_analyzer', lambda: analyzer)
+    return(analyzer)
@@ -0,0 +1,33 @@
+import polars as pl
+from lymphgenerator.benchmark import compare_benchmarks
+
+_process_memory = 250 * 10**6
+
+def _results(wall_time, memory_increase):
+    return(
+        pl.DataFrame(
+            {
+                'benchmark': ['cool_overlaps'],
+                'size': [10**6],
+                'wall_time': [wall_time],
+                'peak_memory': [_process_memory + memory_increase],
+                'memory_increase': [memory_increase]
+            }
+        )
+    )
+
+def test_doubled_allocation_is_a_regression():
+    comparison = compare_benchmarks(_results(1.0, 38 * 10**6), _results(1.0, 19 * 10**6))
+    assert comparison['memory_ratio'][0] == 2
+    assert comparison['regression'][0]
+
+def test_small_differences_are_noise():
+    same = compare_benchmarks(_results(1.0, 19 * 10**6), _results(1.0, 19 * 10**6))
+    assert not same['regression'][0]
+    # A few kilobytes more than nothing is not a regression either
+    tiny = compare_benchmarks(_results(0.01, 4096), _results(0.005, 0))
+    assert not tiny['regression'][0]
+
+def test_slower_run_is_a_regression():
+    comparison = compare_benchmarks(_results(2.0, 19 * 10**6), _results(1.0, 19 * 10**6))
+    assert comparison['regression'][0]
@@ -0,0 +1,64 @@
+import warnings
+import numpy as np
+import polars as pl
+import pytest
+from lymphgenerator import PanelIndex, cool_overlaps
+
+# The cross join cool_overlaps replaced: every variant paired with every
+# interval of its chromosome, kept where the two overlap
+def _cross_join_overlaps(maf_data, panel):
+    joined = maf_data.join(panel, left_on = 'Chromosome', right_on = 'chrom')
+    return(
+        joined.filter(
+            (pl.col('Start_Position') <= pl.col('end')) &
+            (pl.col('End_Position') >= pl.col('start'))
+        ).select(maf_data.columns)
+    )
+
+def _random_case(seed):
+    rng = np.random.default_rng(seed)
+    n = 300
+    starts = rng.integers(1, 5000, n)
+    maf_data = pl.DataFrame(
+        {
+            # Chromosome 3 and X are not in the panel
+            'Chromosome': rng.choice(['1', '2', '3', 'X'], n),
+            'Start_Position': starts,
+            'End_Position': starts + rng.integers(0, 20, n),
+            'id': np.arange(n)
+        }
+    ).with_columns(
+        # Some variants have no coordinates
+        pl.when(pl.col('id') % 17 == 0).then(None).otherwise(pl.col('Start_Position')).alias('Start_Position'),
+        pl.when(pl.col('id') % 23 == 0).then(None).otherwise(pl.col('End_Position')).alias('End_Position')
+    )
+    interval_starts = rng.integers(1, 5000, 40)
+    panel = pl.DataFrame(
+        {
+            'chrom': rng.choice(['1', '2'], 40),
+            # Wide intervals, so many of them overlap each other
+            'start': interval_starts,
+            'end': interval_starts + rng.integers(0, 800, 40)
+        }
+    )
+    return(maf_data, panel)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_cross_join(seed):
+    maf_data, panel = _random_case(seed)
+    expected = _cross_join_overlaps(maf_data, panel).sort('id')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        result = cool_overlaps(maf_data, panel)
+        lazy_result = cool_overlaps(maf_data.lazy(), panel.lazy()).collect()
+    # Same rows, repeated once per overlapping interval, in maf order
+    assert result.equals(expected)
+    assert lazy_result.equals(expected)
+    assert result['id'].is_sorted()
+
+@pytest.mark.parametrize('seed', range(5))
+def test_panel_index_returns_each_row_once(seed):
+    maf_data, panel = _random_case(seed)
+    expected = _cross_join_overlaps(maf_data, panel).unique('id').sort('id')
+    result = cool_overlaps(maf_data, PanelIndex.from_frame(panel))
+    assert result.equals(expected)
@@ -0,0 +1,33 @@
+import polars as pl
+from lymphgenerator import (
+    PipelineMetrics,
+    estimate_sbs_exposure,
+    synthetic_maf
+)
+
+def test_probabilities_with_all_samples_cached(tmp_path, fake_sigprofiler):
+    maf_file = tmp_path / 'cohort.maf'
+    synthetic_maf(3, 200, seed = 1).write_csv(maf_file, separator = '\t')
+    probabilities_file = tmp_path / 'probabilities.parquet'
+
+    def _run():
+        return(
+            estimate_sbs_exposure(
+                out_path = str(tmp_path / 'out'),
+                file_path = str(maf_file),
+                cache = str(tmp_path / 'cache'),
+                probabilities_file = str(probabilities_file),
+                metrics = PipelineMetrics(sinks = [])
+            )
+        )
+
+    first = _run()
+    assert probabilities_file.exists()
+    joined = pl.read_parquet(probabilities_file)
+    assert set(joined['Tumor_Sample_Barcode']) == set(first['Samples'])
+
+    # Every sample is cached now; fitting is skipped and so is the join
+    probabilities_file.unlink()
+    second = _run()
+    assert second.equals(first)
+    assert not probabilities_file.exists()
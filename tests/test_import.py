@@ -0,0 +1,45 @@
+import json
+import subprocess
+import sys
+
+# Heavy dependencies that only the statistics, plotting and SigProfiler
+# code paths need; `import lymphgenerator` must not load them
+heavy_modules = ['scipy', 'matplotlib', 'seaborn', 'SigProfilerAssignment']
+
+# Generous bound, polars alone takes most of it
+max_import_seconds = 2.0
+
+_probe = '''
+import json, sys, time
+start = time.perf_counter()
+import lymphgenerator
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'seconds': elapsed,
+    'loaded': sorted(name for name in sys.modules if name.split('.')[0] in %r)
+}))
+'''
+
+# Run in a fresh interpreter, so modules imported by pytest do not count
+def _import_lymphgenerator():
+    result = subprocess.run(
+        [sys.executable, '-c', _probe % (heavy_modules, )],
+        capture_output = True,
+        text = True,
+        check = True
+    )
+    return(json.loads(result.stdout.splitlines()[-1]))
+
+def test_import_skips_heavy_modules():
+    probe = _import_lymphgenerator()
+    assert probe['loaded'] == []
+
+def test_import_time():
+    # Best of a few runs, so a busy machine does not fail the test
+    seconds = min(_import_lymphgenerator()['seconds'] for _ in range(3))
+    assert seconds < max_import_seconds
+
+def test_lazy_attributes_resolve():
+    import lymphgenerator
+    for name in lymphgenerator._lazy_attributes:
+        assert callable(getattr(lymphgenerator, name))
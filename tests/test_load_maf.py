@@ -0,0 +1,77 @@
+import polars as pl
+import pytest
+from lymphgenerator import (
+    join_mutation_probabilities,
+    load_maf,
+    sbs_maf_columns,
+    synthetic_maf
+)
+
+_keys = ['Tumor_Sample_Barcode', 'Chromosome', 'Start_Position']
+
+# One cohort as a single maf and split over three files, one of them
+# missing a column and one with text in an integer column
+@pytest.fixture
+def maf_files(tmp_path):
+    maf_data = synthetic_maf(6, 200, seed = 2)
+    maf_data.write_csv(tmp_path / 'cohort.maf', separator = '\t')
+    parts = maf_data.with_row_index('_row')
+    for i in range(3):
+        part = parts.filter(pl.col('_row') % 3 == i).drop('_row')
+        if i == 1:
+            part = part.drop('dbSNP_RS')
+        if i == 2:
+            part = part.with_columns(pl.lit('NA').alias('Entrez_Gene_Id'))
+        part.write_csv(tmp_path / f'part_{i}.maf', separator = '\t')
+    return(tmp_path)
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_glob_matches_single_file(maf_files, lazy):
+    single = load_maf(file_path = str(maf_files / 'cohort.maf'), lazy = lazy)
+    for file_path in [
+        str(maf_files / 'part_*.maf'),
+        [str(maf_files / f'part_{i}.maf') for i in range(3)]
+    ]:
+        combined = load_maf(file_path = file_path, lazy = lazy)
+        assert combined.schema == single.schema
+        # Eager reads keep every column, some of which differ between parts
+        assert combined.select(sbs_maf_columns).sort(_keys).equals(
+            single.select(sbs_maf_columns).sort(_keys)
+        )
+
+def test_missing_files_raise(maf_files):
+    with pytest.raises(FileNotFoundError):
+        load_maf(file_path = str(maf_files / 'none_*.maf'))
+    with pytest.raises(FileNotFoundError):
+        load_maf(file_path = [str(maf_files / 'none.maf')])
+    with pytest.raises(ValueError):
+        load_maf()
+
+def test_cached_glob_in_probability_join(maf_files, tmp_path):
+    probabilities_path = tmp_path / 'probabilities'
+    probabilities_path.mkdir()
+    variants = load_maf(file_path = str(maf_files / 'cohort.maf')).filter(
+        pl.col('Tumor_Sample_Barcode') == 'SYN_0'
+    )
+    pl.DataFrame(
+        {
+            'Sample Names': variants['Tumor_Sample_Barcode'],
+            'Chr': variants['Chromosome'],
+            'Pos': variants['Start_Position'].cast(pl.Int64),
+            'MutationType': ['A[C>T]A'] * variants.height,
+            'SBS1': [1.0] * variants.height
+        }
+    ).write_csv(
+        probabilities_path / 'Decomposed_Mutation_Probabilities_SYN_0.txt',
+        separator = '\t'
+    )
+    out_file = join_mutation_probabilities(
+        probabilities_path,
+        tmp_path / 'joined.parquet',
+        how = 'left',
+        maf_cache = tmp_path / 'cache',
+        file_path = str(maf_files / 'part_*.maf')
+    )
+    joined = pl.read_parquet(out_file)
+    assert joined.height == 6 * 200
+    assert joined['SBS1'].is_not_null().sum() > 0
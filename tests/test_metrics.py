@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import polars as pl
+from lymphgenerator import PipelineMetrics, write_sample_mafs
+
+def test_sample_records_have_cpu_time_and_memory(tmp_path):
+    maf_data = pl.DataFrame(
+        {
+            'Tumor_Sample_Barcode': ['a', 'a', 'b'],
+            'Chromosome': ['1', '2', '1'],
+            'Start_Position': [10, 20, 30]
+        }
+    )
+    metrics = PipelineMetrics(sinks = [])
+    write_sample_mafs(maf_data, out_path = str(tmp_path), n_jobs = 2, metrics = metrics)
+    samples = {record['sample']: record for record in metrics.report()['samples']}
+    assert set(samples) == {'a', 'b'}
+    assert samples['a']['rows'] == 2
+    for record in samples.values():
+        assert record['cpu_time'] >= 0
+        assert record['peak_memory'] > 0
+        assert record['bytes'] > 0
+
+# Platforms without the `resource` module, e.g. Windows
+def test_import_without_resource_module():
+    probe = '''
+import sys
+sys.modules['resource'] = None
+import lymphgenerator
+metrics = lymphgenerator.PipelineMetrics(sinks = [])
+with metrics.stage('probe'):
+    pass
+print(metrics.records[0]['peak_memory_workers'])
+'''
+    result = subprocess.run(
+        [sys.executable, '-c', probe],
+        capture_output = True,
+        text = True,
+        check = True
+    )
+    assert result.stdout.strip() == 'None'
@@ -0,0 +1,55 @@
+import numpy as np
+import polars as pl
+from scipy.optimize import nnls
+from lymphgenerator import (
+    bootstrap_sbs_exposure,
+    fit_nnls_exposure,
+    sbs96_channels
+)
+
+# Strongly correlated signatures, like the COSMIC ones, and Poisson
+# noisy mixtures of them
+def _mixtures(n_samples, seed = 0):
+    rng = np.random.default_rng(seed)
+    base = rng.dirichlet(np.ones(96), size = 4)
+    weights = np.stack(
+        [0.7 * base[i % 4] + 0.3 * rng.dirichlet(np.ones(96)) for i in range(30)],
+        axis = 1
+    )
+    exposures = rng.gamma(0.5, 2000, size = (30, n_samples)) * (rng.random((30, n_samples)) < 0.3)
+    counts = rng.poisson(weights @ exposures)
+    names = [f'SBS{i + 1}' for i in range(30)]
+    signatures = pl.DataFrame(weights, schema = names).insert_column(
+        0, pl.Series('MutationType', sbs96_channels)
+    )
+    matrix = pl.DataFrame(counts, schema = [f'S{i}' for i in range(n_samples)]).insert_column(
+        0, pl.Series('MutationType', sbs96_channels)
+    )
+    return(signatures, matrix, weights, counts)
+
+def test_fit_is_the_exact_optimum():
+    signatures, matrix, weights, counts = _mixtures(40)
+    fitted = fit_nnls_exposure(matrix, signatures = signatures)
+    expected = np.stack(
+        [nnls(weights, counts[:, i].astype(float))[0] for i in range(counts.shape[1])]
+    )
+    assert fitted['Samples'].to_list() == matrix.columns[1:]
+    assert np.array_equal(fitted.drop('Samples').to_numpy(), np.rint(expected))
+
+def test_bootstrap_point_estimate_matches_fit():
+    signatures, matrix, _, _ = _mixtures(6, seed = 1)
+    fitted = fit_nnls_exposure(matrix, signatures = signatures)
+    relative = fitted.select(
+        'Samples',
+        *[pl.col(col) / pl.sum_horizontal(pl.exclude('Samples')) for col in fitted.columns[1:]]
+    ).unpivot(index = 'Samples', variable_name = 'signature', value_name = 'expected')
+    intervals = bootstrap_sbs_exposure(
+        matrix,
+        n_bootstrap = 20,
+        signatures = signatures,
+        n_jobs = 1,
+        seed = 0
+    ).join(relative, on = ['Samples', 'signature'])
+    assert intervals.height == 6 * 30
+    assert np.allclose(intervals['exposure'], intervals['expected'])
+    assert (intervals['lower'] <= intervals['upper']).all()
@@ -0,0 +1,46 @@
+import polars as pl
+import pytest
+from lymphgenerator import (
+    PipelineMetrics,
+    run_pipeline,
+    synthetic_maf
+)
+from lymphgenerator.pipeline import main
+
+@pytest.fixture
+def maf_file(tmp_path):
+    path = tmp_path / 'cohort.maf'
+    synthetic_maf(6, 200, seed = 1).write_csv(path, separator = '\t')
+    return(path)
+
+def test_nnls_without_reference_fails_before_any_stage(tmp_path, maf_file, capsys):
+    work_dir = tmp_path / 'work'
+    with pytest.raises(SystemExit) as error:
+        main(['--work-dir', str(work_dir), '--maf', str(maf_file), '--backend', 'nnls'])
+    assert error.value.code == 2
+    assert '--reference-fasta' in capsys.readouterr().err
+    with pytest.raises(ValueError):
+        run_pipeline(work_dir, maf_file, backend = 'nnls', metrics = PipelineMetrics(sinks = []))
+    assert not work_dir.exists()
+
+def test_scale_without_activities_fails_clearly(tmp_path, maf_file, fake_sigprofiler):
+    with pytest.raises(RuntimeError, match = 'No fitted activities'):
+        run_pipeline(
+            tmp_path / 'work',
+            maf_file,
+            samples = ['not_in_cohort'],
+            metrics = PipelineMetrics(sinks = [])
+        )
+
+def test_rerun_with_fewer_samples_scales_only_those(tmp_path, maf_file, fake_sigprofiler):
+    work_dir = tmp_path / 'work'
+    stages = run_pipeline(work_dir, maf_file, metrics = PipelineMetrics(sinks = []))
+    assert pl.read_parquet(stages['scale']['output']).height == 6
+    stages = run_pipeline(
+        work_dir,
+        maf_file,
+        samples = ['SYN_0', 'SYN_1'],
+        metrics = PipelineMetrics(sinks = [])
+    )
+    exposures = pl.read_parquet(stages['scale']['output'])
+    assert sorted(exposures['Samples']) == ['SYN_0', 'SYN_1']